@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""End-to-end benchmark of 'download()' against a local stand-in server
+
+A local HTTP server serves a synthetic result page in the 'rg_meta' format
+and images and thumbnails of configurable sizes, latencies and error rates,
+so that runs are offline and repeatable. Every combination of the limits,
+workers, engines and thumbnail modes given is run in a fresh process, and
+the images/sec, bytes/sec, peak RSS and CPU time of each run are reported:
+
+    python benchmarks/bench_download.py --limits 50,200 --workers 1,8,32 \\
+        --engines urllib,asyncio --thumbnails none,thumbnail \\
+        --latency 0.02 --error_rate 0.05 [--json results.json]
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from google_images_download.google_images_download import (  # noqa: E402
+    GoogleImagesDownloader, get_parser)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves the result page at /search, images at /image/<i>.jpg and
+    thumbnails at /thumbnail/<i>.jpg"""
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, which must not wait for
+    # the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if self.path == '/search':
+            self.send_body(server.page, 'text/html; charset=utf-8')
+            return
+
+        kind, _, name = self.path.lstrip('/').partition('/')
+        if kind not in ('image', 'thumbnail'):
+            self.send_error(404)
+            return
+        time.sleep(server.latency)
+        # the same images fail on every run
+        if random.Random(name).random() < server.error_rate:
+            self.send_error(500)
+            return
+        self.send_body(server.bodies[kind], 'image/jpeg')
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def result_page(host, items):
+    divs = []
+    for i in range(items):
+        meta = {'pt': 'image %d' % i, 'ity': 'jpg', 'oh': 480, 'ow': 640,
+                'rh': 'example.com', 'ou': '%s/image/%d.jpg' % (host, i),
+                'ru': 'http://example.com/%d' % i,
+                'tu': '%s/thumbnail/%d.jpg' % (host, i)}
+        divs.append('<div class="rg_meta notranslate">{}</div>'.format(
+            json.dumps(meta)))
+    return ''.join(divs).encode('utf-8')
+
+
+def start_server(items, size, thumbnail_size, latency, error_rate):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.url = 'http://%s:%d' % server.server_address
+    server.page = result_page(server.url, items)
+    server.bodies = {'image': b'\xff\xd8\xff' + bytes(max(size - 3, 0)),
+                     'thumbnail': b'\xff\xd8\xff' +
+                     bytes(max(thumbnail_size - 3, 0))}
+    server.latency = latency
+    server.error_rate = error_rate
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(url, limit, workers, engine, thumbnails, retries):
+    """Run a single download, in the process of its own it is given"""
+    argv = ['--url', url + '/search', '--limit', str(limit),
+            '--workers', str(workers), '--engine', engine,
+            '--retries', str(retries)]
+    if thumbnails != 'none':
+        argv.append('--' + thumbnails)
+    arguments = get_parser().parse_args(argv)
+    arguments.search_keyword = ['bench']
+    arguments.main_directory = tempfile.mkdtemp(prefix='bench-')
+
+    downloader = GoogleImagesDownloader()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    try:
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            downloader.download(arguments)
+        seconds = time.perf_counter() - start
+    finally:
+        downloader.close()
+        shutil.rmtree(arguments.main_directory)
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    phases = downloader.stats.report()['phases']
+    phase = 'thumbnail' if thumbnails == 'thumbnail_only' else 'image'
+    fetched = phases.get(phase, {'count': 0, 'errors': 0})
+    return {
+        'images': fetched['count'] - fetched['errors'],
+        'bytes': sum(phases.get(name, {}).get('bytes', 0)
+                     for name in ('image', 'thumbnail')),
+        'seconds': seconds,
+        'cpu_seconds': (end_usage.ru_utime - usage.ru_utime +
+                        end_usage.ru_stime - usage.ru_stime),
+        # kilobytes on Linux, bytes on macOS
+        'peak_rss_mb': end_usage.ru_maxrss / (
+            1024 * 1024 if sys.platform == 'darwin' else 1024),
+    }
+
+
+def parse_list(convert):
+    return lambda value: [convert(item) for item in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--limits', type=parse_list(int), default=[50, 200])
+    parser.add_argument('--workers', type=parse_list(int),
+                        default=[1, 8, 32])
+    parser.add_argument('--engines', type=parse_list(str),
+                        default=['urllib', 'asyncio'])
+    parser.add_argument('--thumbnails', type=parse_list(str),
+                        default=['none', 'thumbnail', 'thumbnail_only'],
+                        help='none, thumbnail or thumbnail_only')
+    parser.add_argument('--size', type=int, default=64 * 1024,
+                        help='bytes of every image')
+    parser.add_argument('--thumbnail_size', type=int, default=4 * 1024,
+                        help='bytes of every thumbnail')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds the server waits before every image')
+    parser.add_argument('--error_rate', type=float, default=0.05,
+                        help='share of the images failing with a 500')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='--retries of the downloads, the failing '
+                        'images always fail')
+    parser.add_argument('--json', type=str,
+                        help='also write the results to this JSON file')
+    options = parser.parse_args()
+
+    # enough results for the largest limit, errors included
+    items = int(max(options.limits) / (1 - options.error_rate)) + 20
+    server = start_server(items, options.size, options.thumbnail_size,
+                          options.latency, options.error_rate)
+    context = multiprocessing.get_context('fork')
+
+    print('{:>6} {:>7} {:>8} {:>14} {:>9} {:>10} {:>9} {:>8}'.format(
+        'limit', 'workers', 'engine', 'thumbnails', 'images/s', 'MB/s',
+        'peak MB', 'cpu s'))
+    results = []
+    for limit, workers, engine, thumbnails in itertools.product(
+            options.limits, options.workers, options.engines,
+            options.thumbnails):
+        # a fresh process per run, for its own peak RSS and CPU time
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            result = executor.submit(run, server.url, limit, workers, engine,
+                                     thumbnails, options.retries).result()
+        result.update(limit=limit, workers=workers, engine=engine,
+                      thumbnails=thumbnails)
+        results.append(result)
+        print('{:>6} {:>7} {:>8} {:>14} {:>9.1f} {:>10.2f} {:>9.1f} '
+              '{:>8.2f}'.format(limit, workers, engine, thumbnails,
+                                result['images'] / result['seconds'],
+                                result['bytes'] / result['seconds'] / 1e6,
+                                result['peak_rss_mb'],
+                                result['cpu_seconds']))
+
+    server.shutdown()
+    if options.json:
+        with open(options.json, 'w') as fh:
+            json.dump(results, fh, indent=4)
+
+
+if __name__ == '__main__':
+    main()
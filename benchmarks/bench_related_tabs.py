@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Microbenchmark of the related tabs extraction ('--related_images')
+
+Compares 'GoogleImagesDownloader.get_all_tabs' with the implementation it
+replaced, which rewrote the whole remaining page for every tab and slept
+0.1 seconds per tab. Runs on a saved result page when one is given, on a
+synthetic page otherwise:
+
+    python benchmarks/bench_related_tabs.py [saved_page.html]
+"""
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from google_images_download.google_images_download import (  # noqa: E402
+    GoogleImagesDownloader)
+
+
+TAB = ('<a class="dtviD" href="/search?q=polar+bears&amp;tbm=isch&amp;'
+       'chips=q:polar+bears,g_1:{name}&amp;usg=AI4_-kQ{i}&amp;sa=X&amp;'
+       'ved=0ahUKEwj{i}">{name}</a>')
+ITEM = ('<div class="rg_meta notranslate">{{"ou":"https://example.com/'
+        '{i}.jpg","pt":"a &amp; b","ity":"jpg"}}</div>')
+
+
+def synthetic_page(tabs=40, items=600):
+    html = ''.join(TAB.format(name='tab+%d' % i, i=i) for i in range(tabs))
+    html += ''.join(ITEM.format(i=i) for i in range(items))
+    return str(html.encode('utf-8'))
+
+
+def previous_get_next_tab(raw_page):
+    start_line = start_line_2 = raw_page.find('class="dtviD"')
+    if start_line == -1:
+        return 'no_tabs', '', 0
+
+    start_content = raw_page.find('href="', start_line + 1)
+    end_content = raw_page.find('">', start_content + 1)
+    url_item = 'https://www.google.com'
+    url_item = url_item + raw_page[start_content + 6:end_content]
+    url_item = url_item.replace('&amp;', '&')
+
+    raw_page = raw_page.replace('&amp;', '&')
+    start_content_2 = raw_page.find(':', start_line_2 + 1)
+    end_content_2 = raw_page.find('&usg=', start_content_2 + 1)
+    url_item_name = raw_page[start_content_2 + 1:end_content_2]
+
+    chars = url_item_name.find(',g_1:')
+    chars_end = url_item_name.find(':', chars + 6)
+    if chars_end == -1:
+        updated_item_name = url_item_name[chars + 5:].replace('+', ' ')
+    else:
+        updated_item_name = url_item_name[chars + 5:chars_end]
+        updated_item_name = updated_item_name.replace('+', ' ')
+
+    return url_item, updated_item_name, end_content
+
+
+def previous_get_all_tabs(page, delay=0.1):
+    tabs = {}
+    while True:
+        item, item_name, end_content = previous_get_next_tab(page)
+        if item == 'no_tabs':
+            break
+        if len(item_name) > 100 or item_name == 'background-color':
+            break
+        tabs[item_name] = item
+        time.sleep(delay)
+        page = page[end_content:]
+
+    return tabs
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as fh:
+            page = str(fh.read())
+    else:
+        page = synthetic_page()
+
+    downloader = GoogleImagesDownloader()
+    tabs = downloader.get_all_tabs(page)
+    if tabs != previous_get_all_tabs(page, delay=0):
+        sys.exit('the implementations disagree on this page')
+
+    number = 20
+    previous = timeit.timeit(lambda: previous_get_all_tabs(page, delay=0),
+                             number=number) / number
+    current = timeit.timeit(lambda: downloader.get_all_tabs(page),
+                            number=number) / number
+    # the sleeps are not timed, they simply add up to 0.1s per tab
+    sleeps = 0.1 * len(tabs)
+    downloader.close()
+
+    print('page: {} bytes, {} tabs'.format(len(page), len(tabs)))
+    print('previous: {:9.3f} ms (+{:.1f} s of sleeps)'.format(
+        previous * 1000, sleeps))
+    print('current:  {:9.3f} ms'.format(current * 1000))
+    print('speedup:  {:9.1f}x without the sleeps, {:.0f}x with them'.format(
+        previous / current, (previous + sleeps) / current))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,27 +2,66 @@
 # vim: sw=4:ts=4:sts=4
 
 import argparse
-import codecs
+import asyncio
+import base64
+import contextlib
 import datetime
+import email.utils
+import hashlib
+import io
+import itertools
+import math
 import json
+import multiprocessing
 import os
+import queue
+import random
+import socket
+import sqlite3
 import ssl
-import sys
+import tempfile
+import threading
 import time
+import traceback
+from collections import deque, namedtuple
+from concurrent.futures import (FIRST_COMPLETED, CancelledError, Future,
+                                ProcessPoolExecutor, ThreadPoolExecutor, wait)
 
-import urllib.request
-from urllib.request import Request, urlopen
-from urllib.request import URLError, HTTPError
-from urllib.parse import quote
+from urllib.request import URLError, HTTPError, getproxies, proxy_bypass
+from urllib.parse import quote, unquote, urljoin, urlsplit
 
 import http.client
 from http.client import IncompleteRead, BadStatusLine
 http.client._MAXHEADERS = 1000
 
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # only needed for --near_duplicates and post-processing
+    Image = ImageOps = None
+
 
 USER_AGENT = ('Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 '
               '(KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.36')
 EXTENSIONS = ('jpg', 'gif', 'png', 'bmp', 'svg', 'webp', 'ico')
+# image format of the Content-Type of a response
+MIME_TYPES = {'image/jpeg': 'jpg', 'image/jpg': 'jpg', 'image/pjpeg': 'jpg',
+              'image/gif': 'gif', 'image/png': 'png', 'image/bmp': 'bmp',
+              'image/x-ms-bmp': 'bmp', 'image/svg+xml': 'svg',
+              'image/webp': 'webp', 'image/x-icon': 'ico',
+              'image/vnd.microsoft.icon': 'ico'}
+# image format of the first bytes of a file, svg being text has none
+SIGNATURES = ((b'\xff\xd8\xff', 'jpg'), (b'GIF8', 'gif'),
+              (b'\x89PNG\r\n\x1a\n', 'png'), (b'BM', 'bmp'),
+              (b'RIFF', 'webp'), (b'\x00\x00\x01\x00', 'ico'))
+# Pillow format of the image formats it can write, and the other way round
+PILLOW_FORMATS = {'jpg': 'JPEG', 'png': 'PNG', 'gif': 'GIF', 'bmp': 'BMP',
+                  'webp': 'WEBP', 'ico': 'ICO'}
+PILLOW_EXTENSIONS = dict((value, key) for key, value in PILLOW_FORMATS.items())
+PILLOW_EXTENSIONS['MPO'] = 'jpg'
+# EXIF tag of the orientation of an image
+ORIENTATION = 0x0112
+# bytes read from the network at once when streaming to disk
+CHUNK_SIZE = 64 * 1024
 
 SILENT_MODE = False
 
@@ -51,7 +90,7 @@ def get_parser():
                         help='comma separated additional words added before '
                         'main keyword')
 
-    parser.add_argument('--limit', type=int, defaut=100)
+    parser.add_argument('--limit', type=int, default=100)
 
     parser.add_argument('--single_image', type=str,
                         help='downloading a single image from URL')
@@ -59,9 +98,154 @@ def get_parser():
     parser.add_argument('--output_directory', type=str,
                         help='download images in a specific main directory')
 
-    parser.add_argument('--delay', type=int,
+    parser.add_argument('--delay', type=float,
                         help='delay in seconds to wait between downloading '
-                        'two images')
+                        'two images, see --rate for finer throttling')
+
+    parser.add_argument('--rate', type=float,
+                        help='maximum number of image requests per second')
+
+    parser.add_argument('--host_rate', type=float,
+                        help='maximum number of image requests per second '
+                        'to a single image host')
+
+    parser.add_argument('--bandwidth', type=float,
+                        help='maximum bytes per second downloaded for images')
+
+    parser.add_argument('--search_rate', type=float,
+                        help='maximum number of search page requests per '
+                        'second')
+
+    parser.add_argument('--retries', type=int, default=2,
+                        help='number of times a failed request is retried')
+
+    parser.add_argument('--retry_backoff', type=float, default=0.5,
+                        help='seconds to wait before the first retry, '
+                        'doubling with every retry')
+
+    parser.add_argument('--retry_max_backoff', type=float, default=30,
+                        help='maximum seconds to wait before a retry')
+
+    parser.add_argument('--breaker_threshold', type=int, default=5,
+                        help='number of failures in a row after which a host '
+                        'is no longer requested for a while, 0 to disable')
+
+    parser.add_argument('--breaker_cooldown', type=float, default=60,
+                        help='seconds a failing host is no longer requested')
+
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of images to download concurrently')
+
+    parser.add_argument('--term_workers', type=int, default=1,
+                        help='number of search terms processed concurrently')
+
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of processes the records of the config '
+                        'file are spread over')
+
+    parser.add_argument('--engine', type=str, default='urllib',
+                        help='network engine used for all requests',
+                        choices=['urllib', 'asyncio'])
+
+    parser.add_argument('--pool_size', type=int, default=10,
+                        help='number of idle keep-alive connections kept '
+                        'per host')
+
+    parser.add_argument('--pool_idle_timeout', type=float, default=30,
+                        help='seconds after which an idle keep-alive '
+                        'connection is closed')
+
+    parser.add_argument('--dedupe_store', type=str,
+                        help='directory of a content-addressed store saving '
+                        'every image once, keyword directories get links')
+
+    parser.add_argument('--manifest', type=str,
+                        help='SQLite file recording every downloaded image')
+
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the images the manifest records as '
+                        'downloaded, by default the manifest is '
+                        'manifest.sqlite in the output directory, and '
+                        'continue --keywords_from_file after its checkpoint')
+
+    parser.add_argument('--near_duplicates', type=str,
+                        help='once downloaded, report the images of the '
+                        'output directory that are resized or recompressed '
+                        'copies of another, delete them (skip) or hard link '
+                        'them to it (link), needs Pillow',
+                        choices=['report', 'skip', 'link'])
+
+    parser.add_argument('--near_distance', type=int, default=4,
+                        help='bits by which the 64 bit perceptual hashes of '
+                        'near duplicates differ at most')
+
+    parser.add_argument('--hash_workers', type=int,
+                        help='number of processes hashing the images for '
+                        '--near_duplicates, by default one per CPU')
+
+    parser.add_argument('--max_dimension', type=int,
+                        help='shrink the downloaded images to at most this '
+                        'many pixels on their longest side, needs Pillow')
+
+    parser.add_argument('--convert_format', type=str,
+                        help='re-encode the downloaded images and thumbnails '
+                        'in this format, needs Pillow',
+                        choices=sorted(PILLOW_FORMATS))
+
+    parser.add_argument('--quality', type=int,
+                        help='quality, from 1 to 100, of the images '
+                        're-encoded in jpg or webp')
+
+    parser.add_argument('--strip_exif', action='store_true',
+                        help='re-encode the downloaded images without their '
+                        'EXIF metadata, needs Pillow')
+
+    parser.add_argument('--thumbnail_size', type=int,
+                        help='crop and scale the thumbnails to this many '
+                        'pixels square, needs Pillow')
+
+    parser.add_argument('--process_workers', type=int,
+                        help='number of processes post-processing the '
+                        'images, by default one per CPU')
+
+    parser.add_argument('--work_queue', type=str,
+                        help='SQLite file of search terms shared out between '
+                        'the downloader processes using it')
+
+    parser.add_argument('--lease', type=float, default=60,
+                        help='seconds a search term of the work queue stays '
+                        'with a worker that stopped renewing it')
+
+    parser.add_argument('--max_attempts', type=int, default=3,
+                        help='times a search term of the work queue is '
+                        'attempted before it is recorded as failed')
+
+    parser.add_argument('--checkpoint', type=str,
+                        help='file recording the last completed line of '
+                        '--keywords_from_file, by default the name of the '
+                        'keywords file with .checkpoint in the output '
+                        'directory')
+
+    parser.add_argument('--keyword_error_rate', type=float, default=0.001,
+                        help='share of the new keywords of '
+                        '--keywords_from_file that may be taken for repeats '
+                        'and skipped, lower takes more memory')
+
+    parser.add_argument('--cache_dir', type=str,
+                        help='directory caching the fetched search pages')
+
+    parser.add_argument('--cache_ttl', type=float, default=6 * 3600,
+                        help='seconds after which a cached page is fetched '
+                        'again')
+
+    parser.add_argument('--cache_max_bytes', type=int,
+                        default=512 * 1024 * 1024,
+                        help='size of the page cache above which the least '
+                        'recently used pages are evicted')
+
+    parser.add_argument('--cache_only', action='store_true',
+                        help='only use the pages of the cache, without any '
+                        'network access, implies --no_download')
 
     parser.add_argument('--color', type=str,
                         help='filter on color',
@@ -114,7 +298,25 @@ def get_parser():
                         help='Print the metadata of the image')
 
     parser.add_argument('--extract_metadata', action='store_true',
-                        help='Dumps all the logs into a text file')
+                        help='Dumps all the logs into a JSON Lines file')
+
+    parser.add_argument('--min_bytes', type=int,
+                        help='skip images smaller than this many bytes')
+
+    parser.add_argument('--max_bytes', type=int,
+                        help='skip images larger than this many bytes')
+
+    parser.add_argument('--min_pixels', type=int,
+                        help='skip images with fewer pixels, width times '
+                        'height, than this')
+
+    parser.add_argument('--max_pixels', type=int,
+                        help='skip images with more pixels, width times '
+                        'height, than this')
+
+    parser.add_argument('--stats_json', type=str,
+                        help='write timing and throughput statistics to '
+                        'this JSON file')
 
     parser.add_argument('--socket_timeout', type=float,
                         help='Connection timeout waiting for the image to '
@@ -178,10 +380,14 @@ def get_parser():
                         help='Remains silent. Does not print notification '
                         'messages on the terminal')
 
-    parser.add_argument('--save_source', action='store_true',
+    parser.add_argument('--save_source', type=str,
                         help='creates a text file containing a list of '
                         'downloaded images along with source page url')
 
+    parser.add_argument('--format', type=str,
+                        help='download images with specific format',
+                        choices=EXTENSIONS)
+
     required = parser.add_mutually_exclusive_group(required=True)
     required.add_argument('--keywords', type=str,
                           help='delimited list input')
@@ -189,10 +395,6 @@ def get_parser():
     required.add_argument('--keywords_from_file', type=str,
                           help='extract list of keywords from a text file')
 
-    required.add_argument('--format', type=str,
-                          help='download images with specific format',
-                          choices=EXTENSIONS)
-
     required.add_argument('--url', type=str, help='search with google image URL')
     required.add_argument('--config_file', type=str,
                           help='config file name')
@@ -232,11 +434,16 @@ def get_parser():
 
 def user_input():
     def add_search(new):
+        new.main_directory = new.output_directory or 'downloads'
         if new.keywords:
             search_keyword = new.keywords.split(',')
 
         if new.keywords_from_file:
-            search_keyword = 'keywords_from_file(new.keywords_from_file)'  # TODO
+            checkpoint = new.checkpoint or os.path.join(
+                    new.main_directory,
+                    os.path.basename(new.keywords_from_file) + '.checkpoint')
+            search_keyword = KeywordFile(new.keywords_from_file, checkpoint,
+                                         new.resume, new.keyword_error_rate)
 
         if new.url or new.similar_images:
             current_time = str(datetime.datetime.now()).split('.')[0]
@@ -251,48 +458,2100 @@ def user_input():
     if not args.config_file:
         return [add_search(args)]
 
+    # every record is checked before any of them runs
+    schema = ConfigSchema(parser)
+    streamed = args.config_file.endswith('.jsonl')
     records = []
-    with open(args.config_file) as fh:
-        json_file = json.load(fh)
+    invalid = False
+    for i, record in enumerate(read_config(args.config_file)):
+        try:
+            if isinstance(record, ValueError):
+                raise record
+            new = schema.namespace(record)
+        except ValueError as e:
+            print('Config %d invalid: %s' % (i, e))
+            invalid = True
+            continue
+        if not streamed:
+            new.jobs = args.jobs
+            records.append(add_search(new))
+    if invalid:
+        exit()
+
+    if streamed:
+        # read again as the records run, rather than held in memory
+        def records():
+            for record in read_config(args.config_file):
+                new = schema.namespace(record)
+                new.jobs = args.jobs
+                yield add_search(new)
+
+        return records()
+
+    return records
+
+
+def read_config(path):
+    """Read the records of a config file
+
+    A '.jsonl' file holds a record per line and is streamed, other files
+    hold a JSON object with a 'Records' array. A line that is not valid JSON
+    comes as the ValueError of its decoding, in place of its record."""
+    with open(path) as fh:
+        if not path.endswith('.jsonl'):
+            yield from json.load(fh)['Records']
+            return
+        for line in fh:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    yield ValueError('invalid JSON: {}'.format(e))
+
+
+class ConfigSchema:
+    """Turns config records, dicts of argument names to values, into the
+    namespaces the parser would return for the same arguments
+
+    It is built once from the definition of the parser, and checks the
+    types, choices and mutually exclusive groups of the arguments without
+    going through 'parse_args'. Flags take JSON booleans, and the comma
+    separated arguments may also take lists."""
+
+    def __init__(self, parser):
+        self.actions = {}
+        self.defaults = {}
+        for action in parser._actions:
+            if isinstance(action, argparse._HelpAction):
+                continue
+            self.defaults[action.dest] = action.default
+            for option in action.option_strings:
+                if option.startswith('--'):
+                    self.actions[option[2:]] = action
+        self.groups = [(group.required, group._group_actions)
+                       for group in parser._mutually_exclusive_groups]
+
+    def namespace(self, record):
+        """The namespace of a record, raises ValueError with all of its
+        problems"""
+        if not isinstance(record, dict):
+            raise ValueError('a record must be an object')
+
+        values = dict(self.defaults)
+        given = set()
+        errors = []
+        for key, value in record.items():
+            action = self.actions.get(key)
+            if action is None:
+                errors.append('unrecognized argument: ' + key)
+                continue
+            try:
+                values[action.dest] = self.convert(action, value)
+                given.add(action.dest)
+            except ValueError as e:
+                errors.append('argument --{}: {}'.format(key, e))
+
+        for required, actions in self.groups:
+            names = ['--' + action.dest for action in actions]
+            found = [action for action in actions if action.dest in given]
+            if len(found) > 1:
+                errors.append('arguments {} are not allowed together'.format(
+                    ', '.join('--' + action.dest for action in found)))
+            elif required and not found:
+                errors.append('one of the arguments {} is required'.format(
+                    ' '.join(names)))
+
+        if errors:
+            raise ValueError('; '.join(errors))
+        return argparse.Namespace(**values)
+
+    def convert(self, action, value):
+        if action.nargs == 0:
+            if not isinstance(value, bool):
+                raise ValueError('expected true or false, got %r' % (value,))
+            return action.const if value else action.default
+
+        convert = action.type or str
+        if isinstance(value, list) and convert is str:
+            value = ','.join(str(item) for item in value)
+        if isinstance(value, bool) or not isinstance(value,
+                                                     (str, int, float)):
+            raise ValueError('invalid value: %r' % (value,))
+
+        if convert in (int, float) and not isinstance(value, str):
+            if convert is int and value != int(value):
+                raise ValueError('invalid int value: %r' % (value,))
+            value = convert(value)
+        else:
+            try:
+                value = convert(str(value))
+            except (TypeError, ValueError):
+                raise ValueError('invalid {} value: {!r}'.format(
+                    getattr(convert, '__name__', convert), value))
+
+        if action.choices is not None and value not in action.choices:
+            raise ValueError('invalid choice: %r' % (value,))
+        return value
+
+
+class BloomFilter:
+    """Set of strings in bounded memory, which may wrongly report a string
+    as present
+
+    Sized for 'capacity' strings, with a false positive rate of about
+    'error_rate' up to that many."""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) /
+                               math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.set_bits = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        """Add 'key', True when it was not in the filter yet"""
+        added = False
+        for position in self._positions(key):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] >> bit & 1:
+                self.bits[byte] |= 1 << bit
+                self.set_bits += 1
+                added = True
+        return added
+
+    @property
+    def false_positive_rate(self):
+        """Probability that a string not added yet is reported as present,
+        as filled so far"""
+        return (self.set_bits / self.size) ** self.hashes
+
+    def __contains__(self, key):
+        return all(self.bits[position // 8] >> position % 8 & 1
+                   for position in self._positions(key))
+
+
+class KeywordFile:
+    """Keywords read lazily from a file, a keyword per line
+
+    Blank lines are skipped, and repeated keywords are dropped by a Bloom
+    filter sized from the file, so that memory stays bounded however long
+    the list is; a new keyword is taken for a repeat with a probability of
+    about 'error_rate', and the number of keywords skipped that way is
+    estimated along with the repeats. Once the search terms of a line are
+    complete, its line number and byte offset are recorded in the
+    'checkpoint' file, and with 'resume' reading continues after them. The
+    lines before the checkpoint are then only read again to rebuild the
+    filter. Once a line 'failed', no later line is checkpointed, so that a
+    resumed run reads it again."""
+
+    def __init__(self, path, checkpoint=None, resume=False,
+                 error_rate=0.001):
+        self.path = path
+        self.checkpoint = checkpoint
+        self.resume = resume
+        self.error_rate = error_rate
+        # byte offsets after the lines in progress
+        self.offsets = {}
+        self.repeated = 0
+        # expected number of new keywords taken for repeats
+        self.mistaken = 0
+        # first line that failed, the checkpoint stays before it
+        self.failed_line = None
+
+    def __iter__(self):
+        return (keyword for _, keyword in self.entries(track=False))
+
+    def entries(self, track=True):
+        """Yield the index and keyword of every line with a new keyword,
+        with 'track' its lines are to be passed to 'completed'"""
+        start = self._start()
+        # a line holds at least a few bytes, bounding the keywords
+        seen = BloomFilter(max(1000, os.path.getsize(self.path) // 8),
+                           self.error_rate)
+        self.offsets = {}
+        self.repeated = 0
+        self.mistaken = 0
+        self.failed_line = None
+        offset = 0
+        with open(self.path, 'rb') as fh:
+            for i, line in enumerate(fh):
+                offset += len(line)
+                keyword = line.rstrip(b'\r\n').decode(
+                        'utf-8-sig' if i == 0 else 'utf-8')
+                if not keyword.strip():
+                    continue
+                rate = seen.false_positive_rate
+                added = seen.add(keyword)
+                if offset <= start:
+                    continue
+                if not added:
+                    self.repeated += 1
+                    continue
+                # for every new keyword added about rate / (1 - rate) were
+                # taken for repeats
+                self.mistaken += rate / (1 - rate)
+                if track:
+                    self.offsets[i] = offset
+                yield i, keyword
+        if self.repeated:
+            mistaken = min(self.repeated, round(self.mistaken))
+            sprint('Skipped {} repeated keywords of {}, about {} of which may '
+                   'be new keywords taken for repeats'.format(
+                       self.repeated, self.path, mistaken))
+
+    def _start(self):
+        """Byte offset of the checkpoint when resuming, else 0"""
+        if not (self.resume and self.checkpoint and
+                os.path.exists(self.checkpoint)):
+            return 0
+        with open(self.checkpoint) as fh:
+            checkpoint = json.load(fh)
+        if (checkpoint['path'] != os.path.abspath(self.path) or
+                checkpoint['offset'] > os.path.getsize(self.path)):
+            print('Checkpoint {} is not one of {}, starting over'.format(
+                  self.checkpoint, self.path))
+            return 0
+        sprint('Resuming {} after line {}'.format(self.path,
+                                                  checkpoint['line']))
+        return checkpoint['offset']
+
+    def completed(self, i):
+        """Record line 'i' as the last completed one"""
+        offset = self.offsets.pop(i)
+        if not self.checkpoint or self.failed_line is not None:
+            return
+        os.makedirs(os.path.dirname(self.checkpoint) or '.', exist_ok=True)
+        # replaced in one go, an interruption leaves the previous one
+        partial = self.checkpoint + '.partial'
+        with open(partial, 'w') as fh:
+            json.dump({'path': os.path.abspath(self.path), 'line': i + 1,
+                       'offset': offset}, fh)
+        os.replace(partial, self.checkpoint)
+
+    def failed(self, i):
+        """Record that a search term of line 'i' failed, no line from it on
+        is checkpointed"""
+        if self.failed_line is None:
+            self.failed_line = i
+            if self.checkpoint:
+                sprint('Line {} of {} failed, it is searched again when '
+                       'resuming'.format(i + 1, self.path))
+
+
+class TokenBucket:
+    """Token bucket refilled with 'rate' tokens per second
+
+    It holds at most 'burst' tokens, one second worth of them by default.
+    Rates may be fractional."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """Take tokens, returns the seconds to wait before using them
+
+        Tokens are taken even when the bucket runs short, so that concurrent
+        callers queue up behind each other instead of all waking up at once.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+class RateLimiter:
+    """Request and bandwidth limits shared by all the downloads
+
+    'rate' limits the image requests per second overall and 'host_rate' per
+    image host, 'bandwidth' the bytes per second of the image downloads and
+    'search_rate' the search page requests per second. Each of them is
+    optional. The limiter only computes delays, the callers wait them out
+    the way that suits them."""
+
+    def __init__(self, rate=None, host_rate=None, bandwidth=None,
+                 search_rate=None):
+        self.requests = TokenBucket(rate) if rate else None
+        self.host_rate = host_rate
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.bandwidth = TokenBucket(bandwidth) if bandwidth else None
+        self.search = TokenBucket(search_rate) if search_rate else None
+
+    def request_delay(self, host):
+        """Seconds to wait before sending an image request to the host"""
+        delay = self.requests.reserve() if self.requests else 0
+        if self.host_rate:
+            with self.lock:
+                bucket = self.hosts.get(host)
+                if bucket is None:
+                    bucket = self.hosts[host] = TokenBucket(self.host_rate)
+            delay = max(delay, bucket.reserve())
+        return delay
+
+    def bytes_delay(self, size):
+        """Seconds to wait after receiving 'size' bytes of an image"""
+        return self.bandwidth.reserve(size) if self.bandwidth else 0
+
+    def search_delay(self):
+        """Seconds to wait before sending a search page request"""
+        return self.search.reserve() if self.search else 0
+
+
+class UnwantedImage(Exception):
+    """Raised by a sink to drop a download known to be of no use"""
+
+
+class HostUnavailable(URLError):
+    """Raised instead of sending a request to a host whose circuit is open"""
+
+
+class RetryPolicy:
+    """Retries of failed requests and a circuit breaker per host
+
+    Timeouts, connection errors, truncated responses and the HTTP statuses of
+    'retry_statuses' are retried up to 'retries' times, after a jittered
+    exponential backoff starting at 'backoff' seconds and capped at
+    'max_backoff', or after the 'Retry-After' the server asked for. Requests
+    asking to wait longer than 'max_backoff' are given up.
+
+    After 'threshold' failures in a row, the circuit of a host opens and its
+    requests fail right away with 'HostUnavailable' for 'cooldown' seconds.
+    A single request then probes the host again, closing the circuit when it
+    succeeds. A 'threshold' of 0 disables the breaker."""
+    retry_statuses = (408, 425, 429, 500, 502, 503, 504)
+
+    def __init__(self, retries=2, backoff=0.5, max_backoff=30, threshold=5,
+                 cooldown=60):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = {}
+        self.opened = {}
+        self.lock = threading.Lock()
+
+    def check(self, url):
+        """Raise 'HostUnavailable' when the circuit of the host is open"""
+        host = urlsplit(url).hostname
+        with self.lock:
+            until = self.opened.get(host)
+            if until is None:
+                return
+            now = time.monotonic()
+            if now < until:
+                raise HostUnavailable('circuit open for %s' % host)
+            # let this request probe the host, and hold back the others
+            self.opened[host] = now + self.cooldown
+
+    def succeeded(self, url):
+        host = urlsplit(url).hostname
+        with self.lock:
+            self.failures.pop(host, None)
+            self.opened.pop(host, None)
+
+    def failed(self, url, attempt, error):
+        """Record a failed attempt, returns the seconds to wait before the
+        next one or None to give up"""
+        if not self.retryable(error):
+            return None
+        host = urlsplit(url).hostname
+        with self.lock:
+            failures = self.failures[host] = self.failures.get(host, 0) + 1
+            if self.threshold and failures >= self.threshold:
+                self.opened[host] = time.monotonic() + self.cooldown
+                return None
+        if attempt >= self.retries:
+            return None
+
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        retry_after = self.retry_after(error)
+        if retry_after is not None:
+            if retry_after > self.max_backoff:
+                return None
+            delay = max(delay, retry_after)
+        return delay
+
+    def retryable(self, error):
+        if isinstance(error, HTTPError):
+            return error.code in self.retry_statuses
+        if isinstance(error, HostUnavailable):
+            return False
+        return isinstance(error, (OSError, http.client.HTTPException))
+
+    @staticmethod
+    def retry_after(error):
+        """Seconds to wait asked by the 'Retry-After' header of an error"""
+        value = getattr(error, 'headers', None)
+        value = value and value.get('Retry-After')
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return int(value)
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return max(0, (date - now).total_seconds())
+
+
+class Stats:
+    """Counts, bytes and latencies of the phases of a run, per host as well
+
+    Latencies go to histograms of buckets 10% wider than the previous one,
+    so that memory stays bounded however long the run; the percentiles
+    reported are the upper bounds of their buckets. The 'callback', when
+    there is one, is called with every measurement as it is recorded:
+    'callback(phase, host, seconds, size, failed)'. It is safe to use from
+    concurrent threads."""
+    resolution = 1e-4
+    growth = 1.1
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.started = time.monotonic()
+        self.phases = {}
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def record(self, phase, seconds, host=None, size=0, failed=False):
+        bucket = 0
+        if seconds > self.resolution:
+            bucket = math.ceil(math.log(seconds / self.resolution,
+                                        self.growth))
+        with self.lock:
+            entries = [self.phases.setdefault(phase, self._entry())]
+            if host:
+                phases = self.hosts.setdefault(host, {})
+                entries.append(phases.setdefault(phase, self._entry()))
+            for entry in entries:
+                entry['count'] += 1
+                entry['errors'] += failed
+                entry['bytes'] += size
+                entry['seconds'] += seconds
+                entry['buckets'][bucket] = entry['buckets'].get(bucket, 0) + 1
+        if self.callback:
+            self.callback(phase, host, seconds, size, failed)
+
+    @contextlib.contextmanager
+    def timed(self, phase, host=None):
+        """Record the time spent in a 'with' block"""
+        start = time.monotonic()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.record(phase, time.monotonic() - start, host, failed=failed)
+
+    @staticmethod
+    def _entry():
+        return {'count': 0, 'errors': 0, 'bytes': 0, 'seconds': 0,
+                'buckets': {}}
+
+    def _summary(self, entry):
+        summary = {key: entry[key] for key in ('count', 'errors', 'bytes')}
+        summary['seconds'] = round(entry['seconds'], 6)
+        if entry['seconds']:
+            summary['bytes_per_second'] = round(entry['bytes'] /
+                                                entry['seconds'])
+        buckets = sorted(entry['buckets'].items())
+        for name, quantile in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            seen = 0
+            for bucket, count in buckets:
+                seen += count
+                if seen >= quantile * entry['count']:
+                    break
+            summary[name] = round(self.resolution * self.growth ** bucket, 6)
+        return summary
+
+    def report(self):
+        """The statistics recorded so far, as plain data"""
+        with self.lock:
+            return {
+                'seconds': round(time.monotonic() - self.started, 6),
+                'phases': {phase: self._summary(entry)
+                           for phase, entry in sorted(self.phases.items())},
+                'hosts': {host: {phase: self._summary(entry)
+                                 for phase, entry in sorted(phases.items())}
+                          for host, phases in sorted(self.hosts.items())},
+            }
+
+
+class ConnectionPool:
+    """Idle keep-alive connections of a network engine, kept per host
+
+    At most 'size' idle connections are kept for each host and connections
+    that stayed idle for more than 'idle_timeout' seconds are closed instead
+    of being reused. 'close' is the function closing a connection."""
+
+    def __init__(self, close, size=10, idle_timeout=30):
+        self.close_connection = close
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+        self.tls_resumed = 0
+
+    def get(self, host):
+        """Take an idle connection to the host, or None"""
+        expired = []
+        connection = None
+        with self.lock:
+            idle = self.idle.get(host)
+            while idle:
+                candidate, released = idle.pop()
+                if time.monotonic() - released > self.idle_timeout:
+                    expired.append(candidate)
+                else:
+                    connection = candidate
+                    self.reused += 1
+                    break
+            # the remaining ones are older than the expired ones
+            if idle:
+                expired.extend(candidate for candidate, _ in idle)
+                idle.clear()
+
+        for candidate in expired:
+            self.close_connection(candidate)
+
+        return connection
+
+    def put(self, host, connection):
+        """Give back a connection that can be reused"""
+        with self.lock:
+            idle = self.idle.setdefault(host, deque())
+            if len(idle) < self.size:
+                idle.append((connection, time.monotonic()))
+                return
+
+        self.close_connection(connection)
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection, _ in connections:
+                self.close_connection(connection)
+
+    def stats(self):
+        return {'opened': self.opened, 'reused': self.reused,
+                'tls_resumed': self.tls_resumed}
+
+
+class HTTPSConnection(http.client.HTTPSConnection):
+    """HTTPS connection resuming the TLS sessions of earlier connections"""
+
+    def __init__(self, host, port=None, tls_sessions=None, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.tls_sessions = tls_sessions if tls_sessions is not None else {}
+
+    @property
+    def server(self):
+        """(host, port) of the TLS server, behind the proxy if there is one"""
+        if self._tunnel_host:
+            return self._tunnel_host, self._tunnel_port
+        return self.host, self.port
+
+    def connect(self):
+        # sends the CONNECT request of a proxy tunnel first
+        http.client.HTTPConnection.connect(self)
+        self.sock = self._context.wrap_socket(
+                self.sock, server_hostname=self.server[0],
+                session=self.tls_sessions.get(self.server))
+
+    def remember_session(self):
+        """Store the TLS session for the next connection to the host
+
+        Called once a response was read, as TLS 1.3 only sends its session
+        tickets after the handshake."""
+        if self.sock and self.sock.session:
+            self.tls_sessions[self.server] = self.sock.session
+
+
+def proxy_for(parts, proxies):
+    """(host, port, headers) of the proxy of an url, out of the 'proxies'
+    of 'getproxies', None when the url is reached directly"""
+    proxy = proxies.get(parts.scheme)
+    if not proxy or proxy_bypass(parts.hostname):
+        return None
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    proxy = urlsplit(proxy)
+    headers = {}
+    if proxy.username:
+        credentials = '{}:{}'.format(unquote(proxy.username),
+                                     unquote(proxy.password or ''))
+        headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(
+                credentials.encode('utf-8')).decode('ascii')
+    return proxy.hostname, proxy.port or 80, headers
+
+
+def request_path(parts):
+    path = parts.path or '/'
+    if parts.query:
+        path = path + '?' + parts.query
+    return path
+
+
+class UrllibEngine:
+    """Blocking network engine built on 'http.client'
+
+    Requests run on the calling thread, or on a pool of 'workers' threads
+    when they are submitted. Connections are kept alive and reused per host
+    through a 'ConnectionPool'. The proxies of the environment, http_proxy,
+    https_proxy and no_proxy, are used like 'urllib.request' does, https
+    going through a CONNECT tunnel. Downloads streamed to a sink, the
+    images, are throttled by the 'limiter', a 'RateLimiter', when there is
+    one, and failed requests are retried following the 'retry' policy when
+    there is one. Fetches are timed under their 'phase' by 'stats', when there is
+    one. The errors raised mirror the ones of 'urllib.request'."""
+    name = 'urllib'
+    max_redirects = 10
+
+    def __init__(self, workers=1, pool_size=10, idle_timeout=30):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers) if workers > 1 else None
+        self.pool = ConnectionPool(lambda connection: connection.close(),
+                                   pool_size, idle_timeout)
+        self.ssl_context = ssl.create_default_context()
+        self.tls_sessions = {}
+        self.proxies = getproxies()
+        self.limiter = None
+        self.retry = None
+        self.stats = None
+
+    def fetch(self, url, timeout=None, sink=None, phase='page'):
+        """Fetch the content behind an url
+
+        The content is returned, unless a 'sink' is given: its 'start' is
+        then called with the response headers, the content is written to
+        it chunk by chunk as it arrives, and the sink is returned. The sink
+        is reset before a retry. A sink raising 'UnwantedImage' drops the
+        connection, the rest of the content is never read."""
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                if self.retry:
+                    self.retry.check(url)
+                body = self._follow(url, timeout, sink)
+            except Exception as e:
+                delay = self.retry.failed(url, attempt, e) if self.retry \
+                    else None
+                if delay is None:
+                    if self.stats:
+                        self.stats.record(phase, time.monotonic() - start,
+                                          urlsplit(url).hostname,
+                                          failed=True)
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                if sink is not None:
+                    sink.reset()
+                continue
+            if self.retry:
+                self.retry.succeeded(url)
+            if self.stats:
+                self.stats.record(phase, time.monotonic() - start,
+                                  urlsplit(url).hostname,
+                                  len(body) if sink is None else sink.size)
+            return body
+
+    def _follow(self, url, timeout, sink):
+        """Fetch an url once, following its redirects"""
+        for _ in range(self.max_redirects + 1):
+            response, body = self._request(url, timeout, sink)
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                continue
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason,
+                                response.headers, None)
+            return body
+
+        raise HTTPError(url, response.status, 'Too many redirects',
+                        response.headers, None)
+
+    def _request(self, url, timeout, sink):
+        """Send a single GET request and read the whole response"""
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise URLError('unknown url type: %s' % parts.scheme)
+        host = (parts.scheme, parts.hostname, parts.port)
+        if timeout is None:
+            timeout = socket.getdefaulttimeout()
+        headers = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'identity'}
+        path = request_path(parts)
+        proxy = proxy_for(parts, self.proxies)
+        if proxy and parts.scheme == 'http':
+            # a plain http proxy takes the whole url
+            path = parts._replace(fragment='').geturl()
+            headers.update(proxy[2])
+        limiter = self.limiter if sink is not None else None
+        if limiter:
+            time.sleep(limiter.request_delay(parts.hostname))
+
+        connection = self.pool.get(host)
+        reused = connection is not None
+        while True:
+            if connection:
+                connection.sock.settimeout(timeout)
+            else:
+                connection = self._connect(parts, timeout, proxy)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                break
+            except (ConnectionError, BadStatusLine) as e:
+                connection.close()
+                if reused:
+                    # the server closed the idle connection in the meantime
+                    connection = None
+                    reused = False
+                    continue
+                if isinstance(e, OSError):
+                    raise URLError(e)
+                raise
+            except OSError as e:
+                connection.close()
+                raise URLError(e)
+
+        try:
+            if sink is None or response.status >= 300:
+                body = response.read()
+            else:
+                body = sink
+                sink.start(response.headers)
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sink.write(chunk)
+                    if limiter:
+                        time.sleep(limiter.bytes_delay(len(chunk)))
+        except BaseException:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            if parts.scheme == 'https':
+                connection.remember_session()
+            self.pool.put(host, connection)
+
+        return response, body
+
+    def _connect(self, parts, timeout, proxy=None):
+        host, port = proxy[:2] if proxy else (parts.hostname, parts.port)
+        if parts.scheme == 'https':
+            connection = HTTPSConnection(host, port,
+                                         tls_sessions=self.tls_sessions,
+                                         timeout=timeout,
+                                         context=self.ssl_context)
+            if proxy:
+                connection.set_tunnel(parts.hostname, parts.port,
+                                      headers=proxy[2])
+        else:
+            connection = http.client.HTTPConnection(host, port,
+                                                    timeout=timeout)
+        try:
+            connection.connect()
+        except OSError as e:
+            connection.close()
+            raise URLError(e)
 
-    for i, record in enumerate(json_file['Records']):
-        parser = get_parser()
-        args = [f'--{k}={v}' for k, v in record.items()]
+        self.pool.opened += 1
+        if parts.scheme == 'https' and connection.sock.session_reused:
+            self.pool.tls_resumed += 1
+
+        return connection
+
+    def submit(self, url, timeout=None, sink=None, phase='page'):
+        """Start fetching an url, returns a future of what 'fetch' returns"""
+        if self.executor:
+            return self.executor.submit(self.fetch, url, timeout, sink, phase)
+
+        future = Future()
         try:
-            new = parser.parse_args(args)
+            future.set_result(self.fetch(url, timeout, sink, phase))
         except Exception as e:
-            print('Config %d invalid: %s' % (i, e))
-            exit()
+            future.set_exception(e)
+        return future
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
+        self.pool.clear()
+
+
+class AsyncioEngine:
+    """Network engine running every request on one asyncio event loop
+
+    The loop lives in a background thread, so callers get the same blocking
+    'fetch' and future based 'submit' as with 'UrllibEngine', while up to
+    'workers' requests are in flight without a thread for each of them.
+    Connections are kept alive and reused per host through a
+    'ConnectionPool', and proxies are used, images throttled, requests
+    retried and timed like with 'UrllibEngine'; https proxies need Python
+    3.11. The errors raised mirror the ones of
+    'urllib.request'.
+    """
+    name = 'asyncio'
+    max_redirects = 10
+
+    def __init__(self, workers=1, pool_size=10, idle_timeout=30):
+        self.workers = workers
+        self.pool = ConnectionPool(lambda connection: connection[1].close(),
+                                   pool_size, idle_timeout)
+        self.ssl_context = ssl.create_default_context()
+        self.proxies = getproxies()
+        self.limiter = None
+        self.retry = None
+        self.stats = None
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = asyncio.Semaphore(workers)
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def fetch(self, url, timeout=None, sink=None, phase='page'):
+        """Fetch the content behind an url, see 'UrllibEngine.fetch'"""
+        return self.submit(url, timeout, sink, phase).result()
+
+    def submit(self, url, timeout=None, sink=None, phase='page'):
+        """Start fetching an url, returns a future of what 'fetch' returns"""
+        return asyncio.run_coroutine_threadsafe(
+                self._fetch(url, timeout, sink, phase), self.loop)
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.pool.clear)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    @staticmethod
+    def _retrieve(task):
+        # a task may still fail once its future was cancelled, the
+        # cancellation being lost when it comes along with the end of a
+        # read, and nobody else retrieves the error of an abandoned image
+        if not task.cancelled():
+            task.exception()
+
+    async def _fetch(self, url, timeout, sink, phase):
+        asyncio.current_task().add_done_callback(self._retrieve)
+        # timed from the first attempt out of the queue of the semaphore
+        start = None
+        attempt = 0
+        while True:
+            try:
+                if self.retry:
+                    self.retry.check(url)
+                async with self.semaphore:
+                    start = start or time.monotonic()
+                    body = await self._get(url, timeout, sink)
+            except Exception as e:
+                delay = self.retry.failed(url, attempt, e) if self.retry \
+                    else None
+                if delay is None:
+                    if self.stats:
+                        elapsed = time.monotonic() - start if start else 0
+                        self.stats.record(phase, elapsed,
+                                          urlsplit(url).hostname,
+                                          failed=True)
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                if sink is not None:
+                    sink.reset()
+                continue
+            if self.retry:
+                self.retry.succeeded(url)
+            if self.stats:
+                self.stats.record(phase, time.monotonic() - start,
+                                  urlsplit(url).hostname,
+                                  len(body) if sink is None else sink.size)
+            return body
+
+    async def _get(self, url, timeout, sink):
+        for _ in range(self.max_redirects + 1):
+            status, reason, headers, body = await self._request(url, timeout,
+                                                                sink)
+            location = headers.get('Location')
+            if status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                continue
+            if status >= 400:
+                raise HTTPError(url, status, reason, headers, None)
+            return body
+
+        raise HTTPError(url, status, 'Too many redirects', headers, None)
+
+    async def _request(self, url, timeout, sink):
+        """Send a single GET request and read the whole response
+
+        Like the socket timeout of 'UrllibEngine', 'timeout' applies to the
+        connection and to every read on its own, not to the whole
+        response."""
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise URLError('unknown url type: %s' % parts.scheme)
+        host = (parts.scheme, parts.hostname, parts.port)
+        path = request_path(parts)
+        extra = ''
+        proxy = proxy_for(parts, self.proxies)
+        if proxy and parts.scheme == 'http':
+            # a plain http proxy takes the whole url
+            path = parts._replace(fragment='').geturl()
+            extra = ''.join('{}: {}\r\n'.format(*header)
+                            for header in proxy[2].items())
+        request = ''.join(('GET ', path, ' HTTP/1.1\r\n',
+                           'Host: ', parts.netloc, '\r\n',
+                           'User-Agent: ', USER_AGENT, '\r\n', extra,
+                           'Accept-Encoding: identity\r\n\r\n'))
+        request = request.encode('ascii')
+        if timeout is None:
+            timeout = socket.getdefaulttimeout()
+        limiter = self.limiter if sink is not None else None
+        if limiter:
+            # before connecting, out of the timeouts like the waits of the
+            # bandwidth cap between reads
+            await asyncio.sleep(limiter.request_delay(parts.hostname))
+
+        connection = self.pool.get(host)
+        reused = connection is not None
+        while True:
+            if not connection:
+                connection = await self._connect(parts, timeout, proxy)
+            reader, writer = connection
+            reader = TimedReader(reader, timeout)
+            try:
+                writer.write(request)
+                status, reason, headers, keep_alive = await self._read_head(
+                        reader)
+                break
+            except (ConnectionError, BadStatusLine) as e:
+                writer.close()
+                if reused:
+                    # the server closed the idle connection in the meantime
+                    connection = None
+                    reused = False
+                    continue
+                if isinstance(e, OSError):
+                    raise URLError(e)
+                raise
+            except OSError as e:
+                writer.close()
+                raise URLError(e)
+            except BaseException:
+                writer.close()
+                raise
 
-        records.append(add_search(new))
+        try:
+            if sink is None or status >= 300:
+                chunks = []
+                delimited = await self._read_body(reader, headers,
+                                                  chunks.append)
+                body = b''.join(chunks)
+            else:
+                sink.start(headers)
+                delimited = await self._read_body(reader, headers,
+                                                  sink.write, limiter)
+                body = sink
+        except BaseException:
+            writer.close()
+            raise
+
+        if keep_alive and delimited:
+            self.pool.put(host, connection)
+        else:
+            writer.close()
+
+        return status, reason, headers, body
+
+    async def _connect(self, parts, timeout, proxy=None):
+        https = parts.scheme == 'https'
+        port = parts.port or (443 if https else 80)
+        try:
+            if proxy:
+                connection = await asyncio.wait_for(asyncio.open_connection(
+                        *proxy[:2]), timeout)
+                if https:
+                    await asyncio.wait_for(self._tunnel(
+                            connection, parts.hostname, port, proxy[2]),
+                            timeout)
+            else:
+                connection = await asyncio.wait_for(asyncio.open_connection(
+                        parts.hostname, port,
+                        ssl=self.ssl_context if https else None), timeout)
+        except asyncio.TimeoutError:
+            raise URLError(socket.timeout('timed out'))
+        except OSError as e:
+            raise URLError(e)
+
+        self.pool.opened += 1
+        return connection
+
+    async def _tunnel(self, connection, host, port, headers):
+        """Open a CONNECT tunnel through a proxy and start TLS in it"""
+        reader, writer = connection
+        if not hasattr(writer, 'start_tls'):
+            writer.close()
+            raise URLError('https proxies need Python 3.11 with the asyncio '
+                           'engine')
+        request = ''.join(['CONNECT {0}:{1} HTTP/1.1\r\n'
+                           'Host: {0}:{1}\r\n'.format(host, port)] +
+                          ['{}: {}\r\n'.format(*header)
+                           for header in headers.items()] + ['\r\n'])
+        writer.write(request.encode('ascii'))
+        status, reason, _, _ = await self._read_head(reader)
+        if status != 200:
+            writer.close()
+            raise URLError('Tunnel connection failed: {} {}'.format(status,
+                                                                   reason))
+        await writer.start_tls(self.ssl_context, server_hostname=host)
+
+    async def _read_head(self, reader):
+        line = (await reader.readline()).decode('iso-8859-1')
+        try:
+            version, status, reason = (line.split(None, 2) + [''])[:3]
+            status = int(status)
+        except ValueError:
+            raise BadStatusLine(line)
+        if not version.startswith('HTTP/'):
+            raise BadStatusLine(line)
+
+        headers = http.client.HTTPMessage()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('iso-8859-1').partition(':')
+            headers[name.strip()] = value.strip()
+
+        connection = headers.get('Connection', '').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = connection == 'keep-alive'
+        else:
+            keep_alive = connection != 'close'
+
+        return status, reason.strip(), headers, keep_alive
+
+    async def _read_body(self, reader, headers, write, limiter=None):
+        """Pass the response body to 'write' chunk by chunk, returns whether
+        its end was delimited so that the connection can be reused"""
+        try:
+            if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+                while True:
+                    size = await reader.readline()
+                    size = int(size.split(b';')[0].strip() or b'0', 16)
+                    if size == 0:
+                        await reader.readline()
+                        return True
+                    await self._read_exactly(reader, size, write, limiter)
+                    await reader.readexactly(2)
+
+            length = headers.get('Content-Length')
+            if length is not None:
+                await self._read_exactly(reader, int(length), write, limiter)
+                return True
+
+            while True:
+                chunk = await reader.read(CHUNK_SIZE)
+                if not chunk:
+                    return False
+                write(chunk)
+                if limiter:
+                    await asyncio.sleep(limiter.bytes_delay(len(chunk)))
+        except asyncio.IncompleteReadError as e:
+            raise IncompleteRead(e.partial, e.expected)
+
+    async def _read_exactly(self, reader, size, write, limiter):
+        while size:
+            # whatever has arrived, so that a slow response is not timed out
+            # while it still makes progress
+            chunk = await reader.read(min(size, CHUNK_SIZE))
+            if not chunk:
+                raise IncompleteRead(b'', size)
+            write(chunk)
+            size -= len(chunk)
+            if limiter:
+                await asyncio.sleep(limiter.bytes_delay(len(chunk)))
+
+
+class TimedReader:
+    """Wraps an 'asyncio.StreamReader', every read of which raises
+    'socket.timeout' when nothing arrives within 'timeout' seconds"""
+
+    def __init__(self, reader, timeout):
+        self.reader = reader
+        self.timeout = timeout
+
+    async def _timed(self, read):
+        try:
+            return await asyncio.wait_for(read, self.timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout('timed out')
+
+    def read(self, size):
+        return self._timed(self.reader.read(size))
+
+    def readline(self):
+        return self._timed(self.reader.readline())
+
+    def readexactly(self, size):
+        return self._timed(self.reader.readexactly(size))
+
+
+ENGINES = {engine.name: engine for engine in (UrllibEngine, AsyncioEngine)}
+
+
+class PartialFile:
+    """Temporary file a download is streamed to
+
+    It lives next to its final path, so that it can be renamed into place
+    once the download is complete and never shows up half written.
+
+    When an 'image_format' is expected, downloads whose Content-Type or
+    first bytes tell another format are stopped with 'UnwantedImage', and so
+    are the ones whose Content-Length is out of 'min_bytes' and 'max_bytes',
+    or that stream more than 'max_bytes'."""
+
+    def __init__(self, directory, hashed=False, image_format=None,
+                 min_bytes=None, max_bytes=None):
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix='.',
+                                         suffix='.part')
+        self.file = os.fdopen(fd, 'wb')
+        self.size = 0
+        self.hash = hashlib.sha256() if hashed else None
+        # of the content once replaced by post-processing, see 'processed'
+        self.digest = None
+        self.image_format = image_format
+        self.head = b''
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+
+    def start(self, headers):
+        """Check the headers of the response before its content is read"""
+        length = headers.get('Content-Length', '')
+        if length.isdigit():
+            self.check_size(int(length))
+        if not self.image_format:
+            return
+        content_type = headers.get('Content-Type', '')
+        content_type = content_type.split(';')[0].strip().lower()
+        image_format = MIME_TYPES.get(content_type)
+        if content_type.startswith('text/') or (
+                image_format and image_format != self.image_format):
+            raise UnwantedImage('Wrong image format returned (Content-Type '
+                                '%s)' % content_type)
+
+    def check_size(self, size):
+        if self.min_bytes and size < self.min_bytes:
+            raise UnwantedImage('Image of %d bytes, under --min_bytes' % size)
+        if self.max_bytes and size > self.max_bytes:
+            raise UnwantedImage('Image over %d bytes, over --max_bytes' %
+                                self.max_bytes)
+
+    def write(self, chunk):
+        if self.image_format and self.size < 8:
+            self.check_signature(chunk)
+        if self.max_bytes and self.size + len(chunk) > self.max_bytes:
+            self.check_size(self.size + len(chunk))
+        self.file.write(chunk)
+        self.size += len(chunk)
+        if self.hash:
+            self.hash.update(chunk)
+
+    def check_signature(self, chunk):
+        """Check the first bytes of the content once there are enough"""
+        self.head = (self.head + chunk)[:8]
+        if len(self.head) < 8:
+            return
+        for signature, image_format in SIGNATURES:
+            if self.head.startswith(signature):
+                break
+        else:
+            image_format = 'svg'
+        if image_format != self.image_format:
+            raise UnwantedImage('Wrong image format returned (content of a '
+                                '%s image)' % image_format)
+
+    def reset(self):
+        """Drop what was written so far, to start the download over"""
+        self.file.seek(0)
+        self.file.truncate()
+        self.size = 0
+        self.head = b''
+        if self.hash:
+            self.hash = hashlib.sha256()
+
+    def processed(self, size, digest, image_format):
+        """Record that post-processing replaced the content of the file"""
+        self.size = size
+        self.digest = digest
+        self.image_format = image_format
+
+    def checksum(self):
+        """SHA-256 hex digest of the content of a hashed file"""
+        return self.digest or self.hash.hexdigest()
+
+    def commit(self, path):
+        """Move the complete file to its final path"""
+        self.file.close()
+        os.replace(self.path, path)
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class ImageStore:
+    """Content-addressed store keeping a single copy of every image
+
+    Images are saved once, under the SHA-256 digest of their content, and the
+    per-keyword paths get a hard link to the stored copy (or a symbolic link
+    where hard links are not possible). The 'index.sqlite' database of the
+    store records which search terms, paths and urls refer to each digest.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.index = sqlite3.connect(os.path.join(directory, 'index.sqlite'),
+                                     check_same_thread=False)
+        self.index.execute('CREATE TABLE IF NOT EXISTS refs (digest TEXT, '
+                           'search_term TEXT, path TEXT, url TEXT)')
+        self.index.execute('CREATE INDEX IF NOT EXISTS refs_digest '
+                           'ON refs (digest)')
+        self.saved = 0
+        self.deduplicated = 0
+
+    def stored_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def add(self, partial, path, search_term, url):
+        """Store a complete, hashed, 'PartialFile' and link it to 'path'"""
+        digest = partial.checksum()
+        stored = self.stored_path(digest)
+        with self.lock:
+            if os.path.exists(stored):
+                partial.discard()
+                self.deduplicated += 1
+            else:
+                os.makedirs(os.path.dirname(stored), exist_ok=True)
+                partial.commit(stored)
+                self.saved += 1
+            self.index.execute('INSERT INTO refs VALUES (?, ?, ?, ?)',
+                               (digest, search_term, os.path.abspath(path),
+                                url))
+            self.index.commit()
+
+        # link under a temporary name first, to replace an existing file
+        link = path + '.link'
+        try:
+            os.link(stored, link)
+        except OSError:
+            os.symlink(os.path.abspath(stored), link)
+        os.replace(link, path)
+
+        return digest
+
+    def close(self):
+        self.index.close()
+
+
+class Manifest:
+    """Persistent record of the downloaded images, for resumable runs
+
+    Every image is recorded in an SQLite database, keyed by its directory
+    and url, with its status, path, size and SHA-256 checksum: 'started'
+    when its download begins (the path is then the one of its partial file)
+    and 'complete' once it is in place. The completed images are loaded once,
+    when the manifest is opened; with 'resume' they are skipped without any
+    network traffic.
+
+    Several processes may share a manifest, so the 'started' images are
+    recorded with their owner: the host, process id and a random id of the
+    run. Partial files left behind by an interrupted run, one that was
+    closed or whose process is gone, are removed, so that their images are
+    fetched again; the ones of runs still going are left alone."""
+
+    def __init__(self, path, resume=False):
+        self.resume = resume
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                                       os.urandom(4).hex())
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS images ('
+                        'directory TEXT, url TEXT, status TEXT, path TEXT, '
+                        'size INTEGER, checksum TEXT, owner TEXT, '
+                        'PRIMARY KEY (directory, url))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS images_path '
+                        'ON images (path)')
+        self.completed = {}
+        for directory, url, status, path, owner in self.db.execute(
+                'SELECT directory, url, status, path, owner FROM images'):
+            if status == 'complete':
+                self.completed[(directory, url)] = path
+            elif path and not self.running(owner):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def running(self, owner):
+        """Whether the run owning a 'started' image may still be going"""
+        if not owner:
+            return False
+        host, pid, _ = owner.rsplit(':', 2)
+        if host != socket.gethostname() or os.name == 'nt':
+            # no telling, the partial file is left alone
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except (PermissionError, ValueError):
+            pass
+        return True
+
+    def key(self, directory, url):
+        return os.path.normpath(os.path.abspath(directory)), url
+
+    def done(self, directory, url):
+        """Path of the image when it was completed and the run resumes"""
+        if self.resume:
+            return self.completed.get(self.key(directory, url))
+
+    def started(self, directory, url, partial_path):
+        self._record(self.key(directory, url), 'started', partial_path)
+
+    def complete(self, path, url, size, checksum):
+        key = self.key(os.path.dirname(path), url)
+        path = os.path.abspath(path)
+        self._record(key, 'complete', path, size, checksum)
+        with self.lock:
+            self.completed[key] = path
+
+    def replaced(self, path, original):
+        """Point the images completed at 'path', a near duplicate that was
+        deleted, to the 'original' it is a copy of, so that a resumed run
+        neither fetches them again nor refers to the deleted file"""
+        path = os.path.abspath(path)
+        original = os.path.abspath(original)
+        with self.lock:
+            row = self.db.execute("SELECT size, checksum FROM images "
+                                  "WHERE path = ? AND status = 'complete'",
+                                  (original,)).fetchone()
+            keys = self.db.execute("SELECT directory, url FROM images "
+                                   "WHERE path = ? AND status = 'complete'",
+                                   (path,)).fetchall()
+            self.db.execute("UPDATE images SET path = ?, size = ?, "
+                            "checksum = ? WHERE path = ? "
+                            "AND status = 'complete'",
+                            (original,) + (row or (None, None)) + (path,))
+            self.db.commit()
+            for key in keys:
+                self.completed[key] = original
+
+    def _record(self, key, status, path, size=None, checksum=None):
+        owner = self.owner if status == 'started' else None
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO images (directory, url, '
+                            'status, path, size, checksum, owner) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            key + (status, path, size, checksum, owner))
+            self.db.commit()
+
+    def close(self):
+        # what is still started belongs to a run that is over
+        with self.lock:
+            self.db.execute('UPDATE images SET owner = NULL WHERE owner = ?',
+                            (self.owner,))
+            self.db.commit()
+        self.db.close()
+
+
+class WorkQueue:
+    """Search terms shared out between downloader processes through an
+    SQLite database
+
+    Every process adds the terms it was given, the queue keeping one of
+    each, and leases them one at a time. A lease lasts 'lease' seconds and is
+    renewed by a heartbeat thread for as long as the process runs; the
+    terms of a process that died are leased again once theirs expire.
+    Completed terms are recorded with their error count and worker. A term
+    leased 'max_attempts' times without completing is recorded as failed,
+    with its last error, and is not leased again.
+
+    The processes may be on several machines sharing the file system, whose
+    clocks are then assumed to agree to well within a lease. The journal is
+    left in the rollback mode, as the write-ahead log needs memory shared
+    between the processes."""
+
+    def __init__(self, path, lease=60, worker=None, max_attempts=3):
+        self.lease_time = lease
+        self.max_attempts = max_attempts
+        # unique to the queue, of which a process may open several
+        self.worker = worker or '{}:{}:{}'.format(
+                socket.gethostname(), os.getpid(), os.urandom(4).hex())
+        self.lock = threading.Lock()
+        # transactions are begun explicitly, see '_transaction'
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS terms ('
+                        'term TEXT PRIMARY KEY, position INTEGER, '
+                        'keyword_index INTEGER, keyword TEXT, status TEXT, '
+                        'worker TEXT, expires REAL, '
+                        'attempts INTEGER DEFAULT 0, errors INTEGER, '
+                        'finished REAL, error TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS terms_status '
+                        'ON terms (status, position)')
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self.heartbeat.start()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self.lock:
+            # the write lock is taken up front, so that two workers never
+            # read the same free term
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def add(self, terms, batch_size=1000):
+        """Queue the (index, keyword, search term) tuples not queued yet"""
+        batch = []
+        for position, (i, keyword, term) in enumerate(terms):
+            batch.append((term, position, i, keyword))
+            if len(batch) >= batch_size:
+                self._insert(batch)
+                batch = []
+        self._insert(batch)
+
+    def _insert(self, batch):
+        with self._transaction() as db:
+            db.executemany('INSERT OR IGNORE INTO terms (term, position, '
+                           'keyword_index, keyword, status) '
+                           "VALUES (?, ?, ?, ?, 'queued')", batch)
+
+    def lease(self):
+        """Lease the next free term, an (index, keyword, search term)
+        tuple, None when all of them are leased or done"""
+        now = time.time()
+        with self._transaction() as db:
+            # the terms whose every attempt ended with their worker dying
+            db.execute("UPDATE terms SET status = 'failed', expires = NULL, "
+                       "finished = ?, error = 'lease expired' "
+                       "WHERE status = 'leased' AND expires < ? "
+                       'AND attempts >= ?', (now, now, self.max_attempts))
+            row = db.execute("SELECT term, keyword_index, keyword FROM terms "
+                             "WHERE status = 'leased' AND expires < ? "
+                             'ORDER BY position LIMIT 1', (now,)).fetchone()
+            if row is None:
+                row = db.execute('SELECT term, keyword_index, keyword '
+                                 "FROM terms WHERE status = 'queued' "
+                                 'ORDER BY position LIMIT 1').fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE terms SET status = 'leased', worker = ?, "
+                       'expires = ?, attempts = attempts + 1 '
+                       'WHERE term = ?', (self.worker, now + self.lease_time,
+                                          row[0]))
+        term, i, keyword = row
+        return i, keyword, term
+
+    def leased(self, poll=None):
+        """Yield leased terms until every term is done or failed
+
+        While the remaining terms are leased by other workers, the queue is
+        polled every 'poll' seconds, in case their leases expire."""
+        poll = poll or min(self.lease_time / 4, 5)
+        while True:
+            term = self.lease()
+            if term:
+                yield term
+                continue
+            counts = self.counts()
+            if (counts.get('done', 0) + counts.get('failed', 0) ==
+                    sum(counts.values())):
+                return
+            time.sleep(poll)
+
+    def renew(self):
+        """Extend the leases of this worker"""
+        with self._transaction() as db:
+            db.execute("UPDATE terms SET expires = ? WHERE status = 'leased' "
+                       'AND worker = ?', (time.time() + self.lease_time,
+                                          self.worker))
+
+    def _beat(self):
+        while not self.stopped.wait(self.lease_time / 3):
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                # the next beat may get through before the leases expire
+                print('Work queue heartbeat failed: {}'.format(e))
+
+    def complete(self, term, errors):
+        with self._transaction() as db:
+            db.execute("UPDATE terms SET status = 'done', worker = ?, "
+                       'expires = NULL, errors = ?, finished = ? '
+                       'WHERE term = ?', (self.worker, errors, time.time(),
+                                          term))
+
+    def fail(self, term, error):
+        """Record a failed download of a term leased by this worker, returns
+        True when it was the last attempt and the term failed for good,
+        False when the term went back in the queue"""
+        with self._transaction() as db:
+            row = db.execute("SELECT attempts FROM terms WHERE term = ? "
+                             "AND worker = ? AND status = 'leased'",
+                             (term, self.worker)).fetchone()
+            if row is None:
+                # the lease expired and went to another worker meanwhile
+                return False
+            failed = row[0] >= self.max_attempts
+            db.execute('UPDATE terms SET status = ?, expires = NULL, '
+                       'error = ?, finished = ? WHERE term = ?',
+                       ('failed' if failed else 'queued', error,
+                        time.time() if failed else None, term))
+        return failed
+
+    def release(self, term):
+        """Put a term leased by this worker back in the queue"""
+        with self._transaction() as db:
+            db.execute("UPDATE terms SET status = 'queued', worker = NULL, "
+                       'expires = NULL WHERE term = ? AND worker = ? '
+                       "AND status = 'leased'", (term, self.worker))
+
+    def counts(self):
+        """Number of terms of every status"""
+        with self.lock:
+            return dict(self.db.execute('SELECT status, COUNT(*) FROM terms '
+                                        'GROUP BY status'))
+
+    def close(self):
+        self.stopped.set()
+        self.heartbeat.join()
+        self.db.close()
+
+
+class PageCache:
+    """On-disk cache of the fetched pages, keyed by their url
+
+    Pages older than 'ttl' seconds are fetched again. When the cache holds
+    more than 'max_size' bytes, the least recently used pages are evicted.
+    With 'only', pages are never fetched: 'GoogleImagesDownloader' treats a
+    page missing from the cache as empty."""
+
+    def __init__(self, directory, ttl=6 * 3600, max_size=512 * 1024 * 1024,
+                 only=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.only = only
+        self.lock = threading.Lock()
+        self.size = sum(entry.stat().st_size
+                        for entry in os.scandir(directory)
+                        if entry.name.endswith('.page'))
+
+    def path(self, url):
+        digest = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.page')
+
+    def get(self, url):
+        """Content of the cached page, None when missing or expired"""
+        path = self.path(url)
+        try:
+            fetched = os.stat(path).st_mtime
+            if not self.only and time.time() - fetched > self.ttl:
+                return None
+            with open(path, 'rb') as fh:
+                content = fh.read()
+            # the access time orders the evictions, the modification time
+            # stays the time the page was fetched
+            os.utime(path, (time.time(), fetched))
+        except FileNotFoundError:
+            return None
+
+        return content
+
+    def put(self, url, content):
+        path = self.path(url)
+        fd, partial = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(content)
+        with self.lock:
+            try:
+                self.size -= os.stat(path).st_size
+            except FileNotFoundError:
+                pass
+            os.replace(partial, path)
+            self.size += len(content)
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        entries = sorted((entry.stat().st_atime, entry.stat().st_size,
+                          entry.path) for entry in os.scandir(self.directory)
+                         if entry.name.endswith('.page'))
+        for _, size, path in entries:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            self.size -= size
+
+
+class LineWriter:
+    """Buffered writer of the text files all the downloads append lines to
+
+    Files stay open and lines are buffered until 'flush_interval' seconds
+    passed since the last flush, or until 'flush' or 'close', or until
+    'close_file' for that file alone. Files are emptied the first time they
+    are written to until 'close', unless lines are appended, and are
+    appended to when opened again after 'close_file'. It is safe to use from
+    concurrent threads."""
+
+    def __init__(self, flush_interval=1.0):
+        self.flush_interval = flush_interval
+        self.files = {}
+        # the files written to since 'close', never emptied again
+        self.written = set()
+        self.flushed = time.monotonic()
+        self.lock = threading.Lock()
+
+    def write(self, path, line, append=True):
+        with self.lock:
+            file = self.files.get(path)
+            if file is None:
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                if path in self.written:
+                    append = True
+                self.written.add(path)
+                file = self.files[path] = open(path, 'a' if append else 'w',
+                                               encoding='utf-8')
+            file.write(line)
+            if time.monotonic() - self.flushed >= self.flush_interval:
+                self._flush()
+
+    def write_json(self, path, obj):
+        """Write an object as a line of a JSON Lines file"""
+        self.write(path, json.dumps(obj, sort_keys=True) + '\n',
+                   append=False)
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        for file in self.files.values():
+            file.flush()
+        self.flushed = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            for file in self.files.values():
+                file.close()
+            self.files = {}
+            self.written = set()
+
+    def close_file(self, path):
+        """Write out and close a file no more lines are coming to"""
+        with self.lock:
+            file = self.files.pop(path, None)
+            if file is not None:
+                file.close()
+
+
+# what 'GoogleImagesDownloader.iter_download' yields for every image, with
+# the 'bytes' saved, the 'format' they were saved in and the 'seconds' since
+# the image was picked up
+ImageResult = namedtuple('ImageResult', ['search_term', 'url', 'path',
+                                         'bytes', 'format', 'seconds',
+                                         'status', 'message', 'metadata'])
+
+
+def dhash(path, size=8):
+    """Difference hash of an image file, as an int of 'size' * 'size' bits
+
+    Every bit compares the brightness of two neighbouring pixels of a grey,
+    shrunk, copy of the image, so that resized or recompressed copies of an
+    image get hashes only a few bits apart."""
+    with Image.open(path) as image:
+        # JPEG files are decoded straight at a fraction of their size
+        image.draft('L', (size * 4, size * 4))
+        pixels = image.convert('L').resize((size + 1, size),
+                                           Image.BILINEAR).tobytes()
+    bits = 0
+    for row in range(size):
+        for col in range(row * (size + 1), row * (size + 1) + size):
+            bits = bits << 1 | (pixels[col] > pixels[col + 1])
+    return bits
+
+
+def hash_images(paths):
+    """(path, dhash) of every path, what the '--hash_workers' processes
+    run; the hash is None for the files Pillow cannot read"""
+    hashes = []
+    for path in paths:
+        try:
+            hashes.append((path, dhash(path)))
+        except Exception:
+            hashes.append((path, None))
+    return hashes
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class HashIndex:
+    """Index of int hashes of 'bits' bits, searched for the hashes within
+    'distance' bits of a query
+
+    This is multi-index hashing: the hashes are cut into 'distance' + 1
+    chunks, every chunk with a table from its values to the hashes having
+    them. Two hashes within 'distance' bits of each other have at least one
+    chunk in common, so a search only compares the query with the hashes
+    sharing one of its chunks rather than with every hash."""
+
+    def __init__(self, distance, bits=64):
+        self.distance = distance
+        count = max(1, min(distance + 1, bits))
+        # (shift, mask) of every chunk, of about the same width
+        self.chunks = []
+        start = 0
+        for i in range(count):
+            width = (bits - start) // (count - i)
+            self.chunks.append((start, (1 << width) - 1))
+            start += width
+        self.tables = [{} for _ in self.chunks]
+        self.size = 0
+
+    def add(self, key, item):
+        entry = (key, item)
+        for (shift, mask), table in zip(self.chunks, self.tables):
+            table.setdefault(key >> shift & mask, []).append(entry)
+        self.size += 1
+
+    def search(self, key):
+        """(item, distance) of the keys within 'distance' of 'key'"""
+        found = {}
+        for (shift, mask), table in zip(self.chunks, self.tables):
+            for other, item in table.get(key >> shift & mask, ()):
+                if item not in found:
+                    found[item] = hamming(key, other)
+        return [(item, d) for item, d in found.items()
+                if d <= self.distance]
+
+
+class Resize:
+    """Post-processing step shrinking images to at most 'size' pixels on
+    their longest side"""
+
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, image):
+        image.thumbnail((self.size, self.size), Image.LANCZOS)
+        return image
+
+
+class Fit:
+    """Post-processing step cropping images around their centre and scaling
+    them to 'size' pixels square, for thumbnails of the same shape"""
+
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, image):
+        return ImageOps.fit(image, (self.size, self.size), Image.LANCZOS)
+
+
+def process_image(path, steps, image_format=None, quality=None,
+                  hashed=False):
+    """Run the post-processing 'steps' over an image file, what the
+    '--process_workers' processes run
+
+    The result is encoded in 'image_format', the format of the image by
+    default, and replaces the file in one go. A JPEG saved as one without
+    steps, orientation or 'quality' keeps the quantization tables it was
+    encoded with. Returns its size, SHA-256 digest when 'hashed', format
+    and the seconds it took, or None when the file is left as it was:
+    Pillow cannot read it or it is animated."""
+    start = time.perf_counter()
+    try:
+        image = Image.open(path)
+    except (OSError, ValueError):
+        return None
+    try:
+        if getattr(image, 'is_animated', False):
+            return None
+        source_format = PILLOW_EXTENSIONS.get(image.format)
+        image_format = image_format or source_format
+        if image_format is None:
+            return None
+        options = {}
+        if quality and image_format in ('jpg', 'webp'):
+            options['quality'] = quality
+        if (source_format == image_format == 'jpg' and not steps and
+                not quality and image.getexif().get(ORIENTATION, 1) == 1):
+            # only stripped of its metadata, rather than re-encoded at the
+            # default quality of Pillow
+            options['quality'] = 'keep'
+        else:
+            # the orientation is applied, as the EXIF data is not written
+            # again
+            image = ImageOps.exif_transpose(image)
+            for step in steps:
+                image = step(image)
+        if image_format == 'jpg' and image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB')
+        buffer = io.BytesIO()
+        image.save(buffer, PILLOW_FORMATS[image_format], **options)
+    except Exception as e:
+        raise OSError('Image could not be processed: {}'.format(e)) from None
+    finally:
+        image.close()
+
+    content = buffer.getvalue()
+    with open(path, 'wb') as fh:
+        fh.write(content)
+    digest = hashlib.sha256(content).hexdigest() if hashed else None
+    return len(content), digest, image_format, time.perf_counter() - start
+
+
+class ImagePipeline:
+    """Post-processing of the downloaded images in a pool of processes
+
+    Every image is handed to the pool by the download worker that completed
+    it, so that decoding never holds up the network. The 'steps' are run
+    over the images, and the 'thumbnail_steps' over the thumbnails; a step
+    is a picklable callable taking and returning a PIL image, such as
+    'Resize' or 'Fit'. The result is encoded in 'image_format', without the
+    EXIF metadata, and written over the partial file before it is moved
+    into place, so that no file shows up unprocessed. Only the files with
+    steps of their own are processed, unless they are all converted to an
+    'image_format' or stripped of their EXIF metadata ('strip_exif')."""
+
+    def __init__(self, steps=(), thumbnail_steps=(), image_format=None,
+                 quality=None, workers=None, stats=None, strip_exif=False):
+        self.steps = list(steps)
+        self.thumbnail_steps = list(thumbnail_steps)
+        self.image_format = image_format
+        self.quality = quality
+        self.stats = stats
+        self.strip_exif = strip_exif
+        self.executor = ProcessPoolExecutor(workers)
+
+    def wants(self, thumbnail=False):
+        """Whether the images, or the thumbnails, are processed at all"""
+        steps = self.thumbnail_steps if thumbnail else self.steps
+        return bool(steps or self.image_format or self.strip_exif)
+
+    def submit(self, fetched, thumbnail=False):
+        """Future of the processed 'PartialFile' of a future of one"""
+        result = Future()
+        # an abandoned image is not downloaded at all when it can still be
+        result.add_done_callback(lambda result: result.cancelled() and
+                                 fetched.cancel())
+
+        def process(fetched):
+            failed = fetched.cancelled() or fetched.exception()
+            if not result.set_running_or_notify_cancel():
+                if not failed:
+                    fetched.result().discard()
+                return
+            if fetched.cancelled():
+                result.set_exception(CancelledError())
+                return
+            if fetched.exception():
+                result.set_exception(fetched.exception())
+                return
+
+            partial = fetched.result()
+            # all of it on disk, for the other process to read
+            partial.file.close()
+            try:
+                processing = self.executor.submit(
+                        process_image, partial.path,
+                        self.thumbnail_steps if thumbnail else self.steps,
+                        self.image_format, self.quality,
+                        partial.hash is not None)
+            except RuntimeError as e:
+                partial.discard()
+                result.set_exception(e)
+                return
+            processing.add_done_callback(
+                    lambda processing: self._processed(processing, partial,
+                                                       result))
+
+        fetched.add_done_callback(process)
+        return result
+
+    def _processed(self, processing, partial, result):
+        try:
+            processed = processing.result()
+        except BaseException as e:
+            partial.discard()
+            result.set_exception(e)
+            return
+        if processed:
+            size, digest, image_format, seconds = processed
+            partial.processed(size, digest, image_format)
+            if self.stats:
+                self.stats.record('process', seconds, size=size)
+        result.set_result(partial)
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
 
-    return records
+
+class DownloadStopped(Exception):
+    """Raised to stop a download whose results are no longer wanted"""
+
+
+class PageUnavailable(Exception):
+    """Raised when a search page could not be fetched"""
 
 
 class GoogleImagesDownloader:
+    def __init__(self, stats_callback=None):
+        """'stats_callback' is called with every measurement of the 'stats',
+        see 'Stats'"""
+        self.stats = Stats(stats_callback)
+        self.engine = UrllibEngine()
+        self.engine.stats = self.stats
+        self.store = None
+        self.manifest = None
+        # the manifests opened so far by their path, kept open across the
+        # downloads as they are loaded in full when opened
+        self.manifests = {}
+        self.page_cache = None
+        self.work_queue = None
+        self.pipeline = None
+        # post-processing steps run after the built-in ones, see
+        # 'ImagePipeline'
+        self.steps = []
+        self.thumbnail_steps = []
+        self.limiter = None
+        self.retry = None
+        self.writer = LineWriter()
+        # called with the 'ImageResult' of every image, see 'iter_download'
+        self.image_callback = None
+        # (min_bytes, max_bytes) of the images
+        self.byte_limits = (None, None)
+        self.engine_config = ('urllib', 1, 10, 30)
+
+    def use_engine(self, engine, workers=1, pool_size=10, idle_timeout=30):
+        """Switch to the named network engine
+
+        The current engine, and the connections it keeps alive, is kept when
+        it already has the requested configuration."""
+        config = (engine, workers, pool_size, idle_timeout)
+        if config == self.engine_config:
+            return
+        self.engine.close()
+        self.engine = ENGINES[engine](workers, pool_size, idle_timeout)
+        self.engine.stats = self.stats
+        self.engine_config = config
+
+    def close(self):
+        """Release the resources held by the network engine, the manifests
+        and the files being written"""
+        self.engine.close()
+        for manifest in self.manifests.values():
+            manifest.close()
+        self.manifests = {}
+        self.writer.close()
+
     def download_page(self, url):
-        """Downloading entire Web Document (Raw Page Content)"""
-        req = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
-        resp = urlopen(req)
+        """Downloading entire Web Document (Raw Page Content), raises
+        'PageUnavailable' when it cannot be fetched"""
+        if self.page_cache:
+            content = self.page_cache.get(url)
+            if content is not None:
+                return str(content)
+            if self.page_cache.only:
+                sprint('Page is not in the cache, skipping: ' + url)
+                return ''
+
+        if self.limiter:
+            time.sleep(self.limiter.search_delay())
+        try:
+            content = self.engine.fetch(url)
+        except (OSError, http.client.HTTPException) as e:
+            raise PageUnavailable('Could not open URL: {} ({}: {})'.format(
+                url, type(e).__name__, e)) from None
+        if self.page_cache:
+            self.page_cache.put(url, content)
+
+        return str(content)
 
-        return str(resp.read())
+    def get_next_tab(self, raw_page, start=0):
+        """Finding 'Next Tab' from the given raw page, starting at 'start'
 
-    def get_next_tab(self, raw_page):
-        """Finding 'Next Image' from the given raw page"""
-        start_line = start_line_2 = raw_page.find('class="dtviD"')
+        Only the matched fragment is unescaped, the page itself is left
+        untouched so that it can be walked in a single pass."""
+        start_line = raw_page.find('class="dtviD"', start)
         if start_line == -1:
             return 'no_tabs', '', 0
 
         start_content = raw_page.find('href="', start_line + 1)
         end_content = raw_page.find('">', start_content + 1)
+        if start_content == -1 or end_content == -1:
+            return 'no_tabs', '', 0
+
         url_item = 'https://www.google.com'
         url_item = url_item + raw_page[start_content + 6:end_content]
         url_item = url_item.replace('&amp;', '&')
 
-        raw_page = raw_page.replace('&amp;', '&')
-        start_content_2 = raw_page.find(':', start_line_2 + 1)
-        end_content_2 = raw_page.find('&usg=', start_content_2 + 1)
-        url_item_name = raw_page[start_content_2 + 1:end_content_2]
+        start_content_2 = raw_page.find(':', start_line + 1)
+        url_item_name = raw_page[start_content_2 + 1:end_content]
+        url_item_name = url_item_name.replace('&amp;', '&')
+        url_item_name = url_item_name.split('&usg=')[0]
 
         chars = url_item_name.find(',g_1:')
         chars_end = url_item_name.find(':', chars + 6)
@@ -307,20 +2566,16 @@ class GoogleImagesDownloader:
     def get_all_tabs(self, page):
         """Getting all links with the help of 'get_next_tab'"""
         tabs = {}
+        end_content = 0
         while True:
-            item, item_name, end_content = self.get_next_tab(page)
+            item, item_name, end_content = self.get_next_tab(page,
+                                                             end_content)
             if item == 'no_tabs':
                 break
-            else:
-                if len(item_name) > 100 or item_name == 'background-color':
-                    break
-                else:
-                    # Append all the links in the list named 'Links'
-                    tabs[item_name] = item
-                    # TODO: Timer could be used to slow down the request for
-                    # image downloads
-                    time.sleep(0.1)
-                    page = page[end_content:]
+            if len(item_name) > 100 or item_name == 'background-color':
+                break
+            # Append all the links in the list named 'Links'
+            tabs[item_name] = item
 
         return tabs
 
@@ -347,11 +2602,7 @@ class GoogleImagesDownloader:
             if e.errno != 17:
                 raise
             pass
-        req = Request(url, headers={'User-Agent': USER_AGENT})
-
-        response = urlopen(req, None, 10)
-        data = response.read()
-        response.close()
+        partial = self.fetch_image(url, 10, main_directory)
 
         image_name = str(url[(url.rfind('/')) + 1:])
         if '?' in image_name:
@@ -363,13 +2614,10 @@ class GoogleImagesDownloader:
             image_name = image_name + '.jpg'
 
         try:
-            output_file = open(file_name, 'wb')
-            output_file.write(data)
-            output_file.close()
-        except IOError as e:
-            raise e
-        except OSError as e:
-            raise e
+            partial.commit(file_name)
+        except OSError:
+            partial.discard()
+            raise
         print('completed ====>',
               image_name.encode('raw_unicode_escape').decode('utf-8'))
 
@@ -378,21 +2626,14 @@ class GoogleImagesDownloader:
             searchUrl = ''.join(('https://www.google.com/searchbyimage',
                                  '?site=search&sa=X&image_url=',
                                  similar_images))
-            headers = {}
-            headers['User-Agent'] = USER_AGENT
-
-            req1 = urllib.request.Request(searchUrl, headers=headers)
-            resp1 = urlopen(req1)
-            content = str(resp1.read())
+            content = self.download_page(searchUrl)
             l1 = content.find('AMhZZ')
             l2 = content.find('&', l1)
             urll = content[l1:l2]
 
             newurl = ''.join(('https://www.google.com/search?tbs=sbi:',
                               urll, '&site=search&sa=X'))
-            req2 = urllib.request.Request(newurl, headers=headers)
-            resp2 = urlopen(req2)
-            content = str(resp2.read())
+            content = self.download_page(newurl)
             l3 = content.find('/search?sa=X&amp;q=')
             l4 = content.find(';', l3 + 19)
             urll2 = content[l3 + 19:l4]
@@ -625,26 +2866,18 @@ class GoogleImagesDownloader:
             return size
 
     def keywords_from_file(self, file_name):
-        """keywords from file"""
-        search_keyword = []
-        with codecs.open(file_name, 'r', encoding='utf-8-sig') as f:
-            if '.csv' in file_name or '.txt' in file_name:
-                for line in f:
-                    if line in ['\n', '\r\n']:
-                        pass
-                    else:
-                        ln = line.replace('\n', '').replace('\r', '')
-                        search_keyword.append(ln)
-            else:
-                print('Invalid file type: Valid file types are either .txt '
-                      'or .csv \nexiting...')
-                sys.exit()
-
-        return search_keyword
+        """keywords from file, read lazily as they are iterated"""
+        return KeywordFile(file_name)
 
     def create_directories(self, main_directory, dir_name, thumbnail,
                            thumbnail_only):
         """make directories"""
+        with self.stats.timed('directories'):
+            self._create_directories(main_directory, dir_name, thumbnail,
+                                     thumbnail_only)
+
+    def _create_directories(self, main_directory, dir_name, thumbnail,
+                            thumbnail_only):
         dir_name_thumbnail = dir_name + ' - thumbnail'
         # make a search keyword  directory
         try:
@@ -680,49 +2913,44 @@ class GoogleImagesDownloader:
     def download_image_thumbnail(self, image_url, main_directory, dir_name,
                                  return_image_name, print_urls, socket_timeout,
                                  print_size, no_download, save_source, img_src,
-                                 ignore_urls):
-        """Download Image thumbnails"""
+                                 ignore_urls, fetched=None, search_term=None):
+        """Download Image thumbnails
+
+        'fetched' is a future returned by 'submit_image'; when given, the
+        thumbnail is taken from it instead of being downloaded here."""
         if print_urls or no_download:
             print('Image URL: ' + image_url)
         if no_download:
             return 'success', 'Printed url without downloading'
 
+        directory = ''.join((main_directory, '/', dir_name, ' - thumbnail'))
+        if self.manifest and self.manifest.done(directory, image_url):
+            return 'success', ''.join(('Already downloaded Image Thumbnail '
+                                       '====> ', return_image_name))
+
         download_message = '{} on an image...trying next one... Error: {}'
 
         try:
-            req = Request(image_url, headers={'User-Agent': USER_AGENT})
-
             # TODO: more insanity
             try:
-                # timeout time to download an image
-                if socket_timeout:
-                    timeout = float(socket_timeout)
+                if fetched is None:
+                    partial = self.fetch_image(image_url, socket_timeout,
+                                               directory, thumbnail=True)
                 else:
-                    timeout = 10
-
-                response = urlopen(req, None, timeout)
-                data = response.read()
-                response.close()
+                    partial = fetched.result()
 
-                path = ''.join((main_directory, '/', dir_name, ' - thumbnail/',
-                                return_image_name))
+                path = directory + '/' + return_image_name
 
                 try:
-                    output_file = open(path, 'wb')
-                    output_file.write(data)
-                    output_file.close()
+                    self.save_image(partial, path, search_term, image_url)
                     if save_source:
                         list_path = ''.join((main_directory, '/', save_source,
                                              '.txt'))
-                        list_file = open(list_path, 'a')
-                        list_file.write(path + '\t' + img_src + '\n')
-                        list_file.close()
+                        self.writer.write(list_path,
+                                          path + '\t' + img_src + '\n')
                 except OSError as e:
-                    download_status = 'fail'
-                    download_message = download_message.format('OSError', e)
-                except IOError as e:
-                    download_status = 'fail'
-                    download_message = download_message.format('IOError', e)
+                    partial.discard()
+                    return 'fail', download_message.format('OSError', e)
 
                 download_status = 'success'
                 download_message = ''.join(('Completed Image Thumbnail ====> ',
@@ -755,19 +2983,92 @@ class GoogleImagesDownloader:
 
         return download_status, download_message
 
+    def ignored(self, image_url, ignore_urls):
+        """Check the image url against the 'ignore_urls' parameter"""
+        if not ignore_urls:
+            return False
+        return any(url in image_url for url in ignore_urls.split(','))
+
+    def fetch_image(self, image_url, socket_timeout, directory,
+                    image_format=None, thumbnail=False):
+        """Fetch an image into a 'PartialFile' of the given directory"""
+        return self.submit_image(image_url, socket_timeout, directory,
+                                 image_format, thumbnail).result()
+
+    def submit_image(self, image_url, socket_timeout, directory,
+                     image_format=None, thumbnail=False):
+        """Start fetching an image, returns a future of its 'PartialFile'
+
+        The download is stopped early when it does not turn out to be an
+        image of the expected 'image_format', when there is one, or when it
+        is out of the byte limits, unless it is a 'thumbnail'. The partial
+        file is removed again if the download fails."""
+        # timeout time to download an image
+        if socket_timeout:
+            timeout = float(socket_timeout)
+        else:
+            timeout = 10
+
+        min_bytes, max_bytes = (None, None) if thumbnail else self.byte_limits
+        # next to where it is moved once complete, the store possibly being
+        # on another file system
+        partial = PartialFile(self.store.directory if self.store
+                              else directory,
+                              hashed=bool(self.store or self.manifest),
+                              image_format=image_format,
+                              min_bytes=min_bytes, max_bytes=max_bytes)
+        if self.manifest:
+            self.manifest.started(directory, image_url, partial.path)
+        future = self.engine.submit(image_url, timeout, partial,
+                                    'thumbnail' if thumbnail else 'image')
+
+        def discard_on_failure(future):
+            if future.cancelled() or future.exception():
+                partial.discard()
+
+        future.add_done_callback(discard_on_failure)
+        if self.pipeline and self.pipeline.wants(thumbnail):
+            future = self.pipeline.submit(future, thumbnail)
+        return future
+
+    def abandon_image(self, fetched):
+        """Give up on a future of 'submit_image', removing its partial file
+        whenever it completes"""
+        def discard(future):
+            if not future.cancelled() and not future.exception():
+                future.result().discard()
+
+        fetched.cancel()
+        fetched.add_done_callback(discard)
+
+    def save_image(self, partial, path, search_term, image_url):
+        """Move a complete download to its path, through the image store when
+        there is one"""
+        with self.stats.timed('disk', urlsplit(image_url).hostname):
+            if self.store:
+                self.store.add(partial, path, search_term, image_url)
+            else:
+                partial.commit(path)
+            if self.manifest:
+                self.manifest.complete(path, image_url, partial.size,
+                                       partial.checksum())
+
     def download_image(self, image_url, image_format, main_directory, dir_name,
                        count, print_urls, socket_timeout, prefix, print_size,
                        no_numbering, no_download, save_source, img_src,
-                       silent_mode, thumbnail_only, _format, ignore_urls):
-        """Download Images"""
+                       silent_mode, thumbnail_only, _format, ignore_urls,
+                       fetched=None, search_term=None):
+        """Download Images
+
+        'fetched' is a future returned by 'submit_image'; when given, the
+        image is taken from it instead of being downloaded here."""
         print('download_image(...)')
         if print_urls or no_download:
             sprint('Image URL: ' + image_url)
 
-        if ignore_urls:
-            if any(url in image_url for url in ignore_urls.split(',')):
-                msg = 'Image ignored due to \'ignore_url\' parameter'
-                return 'fail', msg, None, image_url
+        if self.ignored(image_url, ignore_urls):
+            msg = 'Image ignored due to \'ignore_url\' parameter'
+            return 'fail', msg, None, image_url
 
         if thumbnail_only:
             part = str(image_url[(image_url.rfind('/')) + 1:])
@@ -777,42 +3078,54 @@ class GoogleImagesDownloader:
             return ('success', 'Printed url without downloading', None,
                     image_url)
 
+        directory = '{}/{}'.format(main_directory, dir_name)
+        done = self.manifest and self.manifest.done(directory, image_url)
+        if done:
+            return_image_name = os.path.basename(done)
+            return ('success', 'Already downloaded Image ====> ' +
+                    return_image_name, return_image_name, done)
+
+        # the metadata is enough to tell some images are not wanted
+        download_message = self._format_error(image_format, _format)
+        if download_message:
+            return 'fail', download_message, '', ''
+
         download_message = '{} on an image...trying next one... Error: {}'
         try:
-            req = Request(image_url, headers={'User-Agent': USER_AGENT})
-
             # TODO: more insanity
             try:
-                # timeout time to download an image
-                if socket_timeout:
-                    timeout = float(socket_timeout)
-                else:
-                    timeout = 10
-
-                response = urlopen(req, None, timeout)
-                data = response.read()
-                response.close()
+                try:
+                    if fetched is None:
+                        partial = self.fetch_image(image_url, socket_timeout,
+                                                   directory, _format)
+                    else:
+                        partial = fetched.result()
+                except UnwantedImage as e:
+                    return 'fail', '{}. Skipping...'.format(e), '', ''
+
+                # not every response tells its length up front
+                min_bytes = self.byte_limits[0]
+                if min_bytes and partial.size < min_bytes:
+                    partial.discard()
+                    download_message = ('Image of {} bytes, under --min_bytes.'
+                                        ' Skipping...'.format(partial.size))
+                    return 'fail', download_message, '', ''
 
                 # keep everything after the last '/'
                 image_name = image_url.split('/')[-1]
-                if _format and image_format != _format:
-                    download_message = ('Wrong image format returned. '
-                                        'Skipping...')
-                    return 'fail', download_message, '', ''
-
-                extensions = ['jpg', 'jpeg', 'gif', 'png', 'bmp', 'svg',
-                              'webp', 'ico']
-                if not image_format or '.' + image_format not in extensions:
-                    download_message = ('Invalid or missing image format. '
-                                        'Skipping...')
-                    return 'fail', download_message, '', ''
-
-                elif image_name.lower().find('.' + image_format) < 0:
+                if image_name.lower().find('.' + image_format) < 0:
                     image_name = image_name + '.' + image_format
                 else:
                     idx = image_name.lower().find('.' + image_format)
                     idx = idx + len(image_format) + 1
                     image_name = image_name[:idx]
+                if (self.pipeline and self.pipeline.wants() and
+                        partial.image_format and
+                        partial.image_format != image_format):
+                    # converted by the post-processing
+                    image_name = '{}.{}'.format(
+                            os.path.splitext(image_name)[0],
+                            partial.image_format)
 
                 # prefix name in image
                 if prefix:
@@ -829,21 +3142,17 @@ class GoogleImagesDownloader:
                                                   image_name)
 
                 try:
-                    output_file = open(path, 'wb')
-                    output_file.write(data)
-                    output_file.close()
+                    self.save_image(partial, path, search_term, image_url)
                     if save_source:
                         list_path = '{}/{}.txt'.format(main_directory,
                                                        save_source)
-                        list_file = open(list_path, 'a')
-                        list_file.write(path + '\t' + img_src + '\n')
-                        list_file.close()
+                        self.writer.write(list_path,
+                                          path + '\t' + img_src + '\n')
                     absolute_path = os.path.abspath(path)
                 except OSError as e:
-                    download_status = 'fail'
-                    download_message = download_message.format('OSError', e)
-                    return_image_name = ''
-                    absolute_path = ''
+                    partial.discard()
+                    return ('fail', download_message.format('OSError', e), '',
+                            '')
 
                 # return image name back to calling method to use it for
                 # thumbnail downloads
@@ -908,52 +3217,168 @@ class GoogleImagesDownloader:
         return (download_status, download_message, return_image_name,
                 absolute_path)
 
-    def _get_next_item(self, s):
-        """Finding 'Next Image' from the given raw page"""
-        start_line = s.find('rg_meta notranslate')
-        # breakpoint()
-        if start_line == -1:  # If no links are found then give an error!
-            return 'no_links', 0
-        else:
-            start_line = s.find('class="rg_meta notranslate">')
-            start_object = s.find('{', start_line + 1)
-            end_object = s.find('</div>', start_object + 1)
-            object_raw = str(s[start_object:end_object])
-
-            # remove escape characters based on python version
-            try:
-                object_decode = bytes(object_raw, 'utf-8').decode(
-                        'unicode_escape')
-                final_object = json.loads(object_decode)
-            except Exception as e:
-                print('--exception--', e)
-                final_object = ''
-
-            return final_object, end_object
-
-    def _get_all_items(self, page, main_directory, dir_name, limit, arguments):
-        """Getting all links with the help of '_get_next_item'"""
+    def _iter_items(self, page):
+        """Finding every 'Next Image' of the given raw page
+
+        Walks the page once and lazily yields the raw, still encoded, metadata
+        object of each result; see '_decode_item'."""
+        marker = 'class="rg_meta notranslate">'
+        start_line = page.find(marker)
+        while start_line != -1:
+            start_object = page.find('{', start_line + 1)
+            end_object = page.find('</div>', start_object + 1)
+            if start_object == -1 or end_object == -1:
+                return
+            yield page[start_object:end_object]
+            start_line = page.find(marker, end_object)
+
+    def _decode_item(self, object_raw):
+        """Decode a raw metadata object, '' if it cannot be decoded"""
+        # remove escape characters based on python version
+        try:
+            object_decode = bytes(object_raw, 'utf-8').decode(
+                    'unicode_escape')
+            return json.loads(object_decode)
+        except Exception as e:
+            print('--exception--', e)
+            return ''
+
+    def _format_error(self, image_format, _format):
+        """Why an image of the given metadata format is skipped, None when it
+        is not"""
+        if _format and image_format != _format:
+            return 'Wrong image format returned. Skipping...'
+        extensions = ['jpg', 'jpeg', 'gif', 'png', 'bmp', 'svg', 'webp',
+                      'ico']
+        if not image_format or image_format not in extensions:
+            return 'Invalid or missing image format. Skipping...'
+        return None
+
+    def _pixels_error(self, obj, arguments):
+        """Why an image is skipped from its metadata dimensions, None when it
+        is not"""
+        try:
+            pixels = int(obj['image_width']) * int(obj['image_height'])
+        except (TypeError, ValueError):
+            return None
+        if arguments['min_pixels'] and pixels < arguments['min_pixels']:
+            return 'Image of {} pixels, under --min_pixels. Skipping...'.format(
+                    pixels)
+        if arguments['max_pixels'] and pixels > arguments['max_pixels']:
+            return 'Image of {} pixels, over --max_pixels. Skipping...'.format(
+                    pixels)
+        return None
+
+    def _needs_fetch(self, obj, directory, arguments):
+        """Whether 'download_image' is going to fetch the image"""
+        image_url = obj['image_link']
+        if arguments['no_download'] or arguments['thumbnail_only']:
+            return False
+        if self.ignored(image_url, arguments['ignore_urls']):
+            return False
+        if self._format_error(obj['image_format'], arguments['format']):
+            return False
+        if self._pixels_error(obj, arguments):
+            return False
+        return not (self.manifest and self.manifest.done(directory, image_url))
+
+    def _needs_thumbnail(self, obj, directory, arguments):
+        """Whether 'download_image_thumbnail' is going to fetch the thumbnail
+        of the image"""
+        if arguments['no_download']:
+            return False
+        if arguments['thumbnail_only']:
+            if self.ignored(obj['image_link'], arguments['ignore_urls']):
+                return False
+            if self._pixels_error(obj, arguments):
+                return False
+        elif not (arguments['thumbnail'] and
+                  self._needs_fetch(obj, directory, arguments)):
+            return False
+        return not (self.manifest and
+                    self.manifest.done(directory + ' - thumbnail',
+                                       obj['image_thumbnail_url']))
+
+    def _get_all_items(self, page, main_directory, dir_name, limit, arguments,
+                       search_term=None, metadata_path=None):
+        """Getting all links with the help of '_iter_items'
+
+        The metadata of every downloaded item is written to the JSON Lines
+        file at 'metadata_path' as it completes, when there is one.
+
+        With more than one worker, image and thumbnail downloads are handed to
+        the engine while the page keeps being parsed, the thumbnail of an item
+        along with its image. Results are still consumed in page order, so the
+        numbering and the returned lists match a serial run."""
         items = []
         abs_path = []
         errorCount = 0
-        i = 0
         count = 1
-        while count < limit + 1:
-            obj, end_content = self._get_next_item(page)
-            if obj == 'no_links':
-                print('no links!')
-                break
-            elif obj == '':
-                page = page[end_content:]
-            elif arguments['offset'] and count < arguments['offset']:
-                count += 1
-                page = page[end_content:]
-            else:
-                # format the item for readability
-                obj = self.format_object(obj)
+        workers = arguments.get('workers') or 1
+        pool = workers > 1
+        # keep more downloads queued than workers so that none of them idles
+        window = workers * 2 if pool else 1
+        pending = deque()
+        raw_items = self._iter_items(page)
+        no_links = False
+        try:
+            while count < limit + 1:
+                # never have more items in flight than images still missing,
+                # so that exactly the items of a serial run are attempted
+                while (not no_links and len(pending) < window and
+                       count + len(pending) < limit + 1):
+                    parse_start = time.monotonic()
+                    object_raw = next(raw_items, None)
+                    if object_raw is None:
+                        no_links = True
+                        break
+                    if arguments['offset'] and count < arguments['offset']:
+                        # skipped items are never decoded
+                        count += 1
+                        continue
+                    obj = self._decode_item(object_raw)
+                    if obj == '':
+                        continue
+
+                    # format the item for readability
+                    obj = self.format_object(obj)
+                    self.stats.record('parse', time.monotonic() - parse_start)
+                    fetched = None
+                    thumbnail_fetched = None
+                    directory = '{}/{}'.format(main_directory, dir_name)
+                    if pool and self._needs_fetch(obj, directory, arguments):
+                        fetched = self.submit_image(
+                                obj['image_link'],
+                                arguments['socket_timeout'],
+                                directory, arguments['format'])
+                    if pool and self._needs_thumbnail(obj, directory,
+                                                      arguments):
+                        thumbnail_fetched = self.submit_image(
+                                obj['image_thumbnail_url'],
+                                arguments['socket_timeout'],
+                                directory + ' - thumbnail', thumbnail=True)
+                    pending.append((obj, fetched, thumbnail_fetched,
+                                    time.monotonic()))
+
+                if not pending:
+                    print('no links!')
+                    break
+
+                obj, fetched, thumbnail_fetched, queued = pending.popleft()
                 if arguments['metadata']:
                     sprint('\nImage Metadata: ' + str(obj))
 
+                # skipped from the metadata, without any request
+                download_message = self._pixels_error(obj, arguments)
+                if download_message:
+                    sprint(download_message)
+                    errorCount += 1
+                    if self.image_callback:
+                        self.image_callback(self._image_result(
+                                obj, search_term, 'fail', download_message,
+                                None, queued))
+                    continue
+
                 # download the images
                 # TODO: can we pass kwargs
                 (download_status, download_message, return_image_name,
@@ -974,9 +3399,15 @@ class GoogleImagesDownloader:
                          arguments['silent_mode'],
                          arguments['thumbnail_only'],
                          arguments['format'],
-                         arguments['ignore_urls'])
+                         arguments['ignore_urls'],
+                         fetched,
+                         search_term)
 
                 sprint(download_message)
+                if self.image_callback:
+                    self.image_callback(self._image_result(
+                            obj, search_term, download_status,
+                            download_message, absolute_path, queued))
 
                 if download_status == 'success':
                     # download image_thumbnails
@@ -992,26 +3423,33 @@ class GoogleImagesDownloader:
                                 arguments['no_download'],
                                 arguments['save_source'],
                                 obj['image_source'],
-                                arguments['ignore_urls'])
+                                arguments['ignore_urls'],
+                                thumbnail_fetched,
+                                search_term)
                         download_status, download_message_thumbnail = res
 
                         sprint(download_message_thumbnail)
 
                     count += 1
                     obj['image_filename'] = return_image_name
+                    if metadata_path:
+                        self.writer.write_json(metadata_path, obj)
                     # Append all the links in the list named 'Links'
                     items.append(obj)
                     abs_path.append(absolute_path)
                 else:
                     errorCount += 1
+                    if thumbnail_fetched:
+                        self.abandon_image(thumbnail_fetched)
 
                 # delay param
                 if arguments['delay']:
                     time.sleep(arguments['delay'])
-
-                page = page[end_content:]
-
-            i += 1
+        finally:
+            for obj, fetched, thumbnail_fetched, queued in pending:
+                for future in (fetched, thumbnail_fetched):
+                    if future:
+                        self.abandon_image(future)
 
         if count < limit:
             msg = ('\n\nUnfortunately all {} could not be downloaded because '
@@ -1021,107 +3459,592 @@ class GoogleImagesDownloader:
 
         return items, errorCount, abs_path
 
+    def _image_result(self, obj, search_term, status, message, path,
+                      queued):
+        size = 0
+        image_format = obj['image_format']
+        if status == 'success' and path and os.path.isfile(path):
+            size = os.path.getsize(path)
+            # the format the file was saved in, possibly converted
+            extension = os.path.splitext(path)[1][1:].lower()
+            if extension in EXTENSIONS:
+                image_format = extension
+        return ImageResult(search_term, obj['image_link'], path or None, size,
+                           image_format, time.monotonic() - queued,
+                           status, message, obj)
+
+    def iter_download(self, arguments, buffer=100):
+        """Run 'download' in the background, yielding the 'ImageResult' of
+        every image as soon as it is done
+
+        The download pauses while 'buffer' results wait to be consumed, and
+        stops when the iteration is stopped. Errors of the download are
+        raised once the results before them are consumed."""
+        results = queue.Queue(buffer)
+        stopped = threading.Event()
+        done = object()
+
+        def put(result):
+            while not stopped.is_set():
+                try:
+                    results.put(result, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+            raise DownloadStopped()
+
+        def run():
+            try:
+                self.download(arguments)
+                result = done
+            except Exception as e:
+                result = e
+            try:
+                put(result)
+            except DownloadStopped:
+                pass
+
+        self.image_callback = put
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            while True:
+                result = results.get()
+                if result is done:
+                    return
+                if isinstance(result, Exception):
+                    raise result
+                yield result
+        finally:
+            stopped.set()
+            thread.join()
+            self.image_callback = None
+
     def download(self, arguments):
+        steps = self.steps
+        if arguments.max_dimension:
+            steps = [Resize(arguments.max_dimension)] + steps
+        thumbnail_steps = self.thumbnail_steps
+        if arguments.thumbnail_size:
+            thumbnail_steps = [Fit(arguments.thumbnail_size)] + thumbnail_steps
+        processed = (steps or thumbnail_steps or arguments.convert_format or
+                     arguments.strip_exif)
+        if (arguments.near_duplicates or processed) and Image is None:
+            raise Exception('--near_duplicates and the post-processing of '
+                            'the images need Pillow, which is not installed')
+        # the statistics of this download alone
+        self.stats = Stats(self.stats.callback)
+        self.use_engine(arguments.engine, arguments.workers,
+                        arguments.pool_size, arguments.pool_idle_timeout)
+        self.engine.stats = self.stats
+        if (arguments.rate or arguments.host_rate or arguments.bandwidth or
+                arguments.search_rate):
+            self.limiter = RateLimiter(arguments.rate, arguments.host_rate,
+                                       arguments.bandwidth,
+                                       arguments.search_rate)
+        self.engine.limiter = self.limiter
+        self.byte_limits = (arguments.min_bytes, arguments.max_bytes)
+        self.engine.retry = self.retry = RetryPolicy(
+                arguments.retries, arguments.retry_backoff,
+                arguments.retry_max_backoff, arguments.breaker_threshold,
+                arguments.breaker_cooldown)
+        if arguments.dedupe_store:
+            self.store = ImageStore(arguments.dedupe_store)
+        manifest = arguments.manifest
+        if arguments.resume and not manifest:
+            os.makedirs(arguments.main_directory, exist_ok=True)
+            manifest = os.path.join(arguments.main_directory,
+                                    'manifest.sqlite')
+        if manifest:
+            path = os.path.abspath(manifest)
+            if path not in self.manifests:
+                self.manifests[path] = Manifest(path)
+            self.manifest = self.manifests[path]
+            self.manifest.resume = arguments.resume
+        if arguments.cache_only:
+            if not arguments.cache_dir:
+                raise Exception('--cache_only needs a --cache_dir')
+            # no network access at all
+            arguments.no_download = True
+        if arguments.work_queue:
+            self.work_queue = WorkQueue(arguments.work_queue, arguments.lease,
+                                        max_attempts=arguments.max_attempts)
+        if processed:
+            self.pipeline = ImagePipeline(steps, thumbnail_steps,
+                                          arguments.convert_format,
+                                          arguments.quality,
+                                          arguments.process_workers,
+                                          self.stats, arguments.strip_exif)
+        if arguments.cache_dir:
+            self.page_cache = PageCache(arguments.cache_dir,
+                                        arguments.cache_ttl,
+                                        arguments.cache_max_bytes,
+                                        arguments.cache_only)
+
+        try:
+            paths, errors = self._download(arguments)
+            if arguments.near_duplicates:
+                self.handle_near_duplicates(arguments.main_directory,
+                                            arguments.near_duplicates,
+                                            arguments.near_distance,
+                                            arguments.hash_workers)
+            if arguments.near_duplicates == 'skip':
+                # the deleted images are no longer part of the result
+                paths = dict((term, [path for path in term_paths
+                                     if os.path.exists(path)])
+                             for term, term_paths in paths.items())
+            return paths, errors
+        finally:
+            if arguments.stats_json:
+                with open(arguments.stats_json, 'w') as fh:
+                    json.dump(self.stats.report(), fh, indent=4)
+            if self.pipeline:
+                self.pipeline.close()
+                self.pipeline = None
+            if self.store:
+                self.store.close()
+                self.store = None
+            self.manifest = None
+            if self.work_queue:
+                self.work_queue.close()
+                self.work_queue = None
+            self.page_cache = None
+            self.limiter = self.engine.limiter = None
+            self.retry = self.engine.retry = None
+            self.byte_limits = (None, None)
+            self.writer.close()
+
+    def _download(self, arguments):
         paths = {}
-        errorCount = None
 
         total_errors = 0
-        for pky in arguments.prefix_keywords.split(','):
-            for sky in arguments.suffix_keywords.split(','):
-                for i, ky in enumerate(arguments.search_keyword):
-                    search_term = ' '.join([pky, ky, sky])
-                    sprint(f'\nItem no.: {i+1} --> Item name = {search_term}\n'
-                           'Evaluating...')
-
-                    if self.image_directory:
-                        dir_name = self.image_directory
-                    elif self.no_directory:
-                        dir_name = ''
-                    else:
-                        dir_name = search_term
-                        if self.color:
-                            # sub-directory
-                            dir_name = '{}-{}'.format(dir_name,
-                                                      self.color)
-
-                    if not self.no_download:
-                        # create directories in OS
-                        self.create_directories(arguments.main_directory,
-                                                dir_name,
-                                                self.thumbnail,
-                                                self.thumbnail_only)
-
-                    # building URL with params
-                    params = self.build_url_parameters(arguments)
-
-                    # building main search url
-                    url = self.build_search_url(search_term, params,
-                                                self.url,
-                                                self.similar_images,
-                                                self.specific_site,
-                                                self.safe_search)
-
-                    raw_html = self.download_page(url)  # download page
-
-                    if self.no_download:
-                        sprint('Getting URLs without downloading images...')
-                    else:
-                        sprint('Starting Download...')
-
-                    # get all image items and download images
-                    items, errorCount, abs_path = self._get_all_items(
-                            raw_html, arguments.main_directory, dir_name,
-                            arguments.limit,
-                            arguments)
-                    paths[search_term] = abs_path
-
-                    # dumps into a json file
-                    if self.extract_metadata:
-                        try:
-                            if not os.path.exists('logs'):
-                                os.makedirs('logs')
-                        except OSError as e:
-                            print(e)
-                        json_file = open('logs/{}.json'.format(ky), 'w')
-                        json.dump(items, json_file, indent=4, sort_keys=True)
-                        json_file.close()
-
-                    # Related images
-                    if self.related_images:
-                        print('\nGetting list of related keywords...'
-                              'this may take a few moments')
-                        tabs = self.get_all_tabs(raw_html)
-                        for key, value in tabs.items():
-                            final_search_term = '{}-{}'.format(search_term, key)
-                            print('\nNow Downloading - ' + final_search_term)
-                            new_raw_html = self.download_page(value)
-                            self.create_directories(
-                                    arguments.main_directory,
-                                    final_search_term,
-                                    self.thumbnail,
-                                    self.thumbnail_only)
-                            self._get_all_items(new_raw_html, arguments.main_directory,
-                                                search_term + ' - ' + key,
-                                                arguments.limit, arguments)
-
-                    i += 1
-                    total_errors = total_errors + errorCount
-                    sprint('\nErrors: ' + str(errorCount) + '\n')
+        # the helpers below look the options up by name
+        options = vars(arguments)
+        prefixes = arguments.prefix_keywords.split(',')
+        suffixes = arguments.suffix_keywords.split(',')
+        work_queue = self.work_queue
+        keywords = arguments.search_keyword
+        # the paths of a keyword file are not held on to, as many as its
+        # lines, 'iter_download' streams them
+        collect_paths = not isinstance(keywords, KeywordFile)
+        if not collect_paths:
+            # a line at a time, so that the search terms of a line complete
+            # together and the line can be checkpointed
+            terms = ((i, ky, ' '.join(filter(None, [pky, ky, sky])))
+                     for i, ky in keywords.entries(track=not work_queue)
+                     for pky in prefixes for sky in suffixes)
+        else:
+            terms = ((i, ky, ' '.join(filter(None, [pky, ky, sky])))
+                     for pky in prefixes for sky in suffixes
+                     for i, ky in enumerate(keywords))
+        terms_per_line = len(prefixes) * len(suffixes)
+        collected = [0]
+
+        download_term = self._download_term
+        if work_queue:
+            # every worker adds the terms it was given and the queue keeps
+            # track of them instead of the checkpoint
+            work_queue.add(terms)
+            terms = work_queue.leased()
+            download_term = self._download_leased
+            keywords = None
+
+        # search terms are handed to a pool of 'term_workers' threads, at
+        # most that many at a time, and their results are collected in order
+        term_workers = arguments.term_workers or 1
+        pool = ThreadPoolExecutor(term_workers) if term_workers > 1 else None
+        pending = deque()
+
+        def collect():
+            i, search_term, result = pending.popleft()
+            collected[0] += 1
+            try:
+                abs_path, errorCount = result.result()
+            except PageUnavailable as e:
+                # the term is not done, its line is not to be checkpointed
+                print('Search term {} failed: {}'.format(search_term, e))
+                abs_path, errorCount = [], 1
+                if keywords:
+                    keywords.failed(i)
+            if collect_paths:
+                paths[search_term] = abs_path
+            elif keywords and collected[0] % terms_per_line == 0:
+                keywords.completed(i)
+            return errorCount
+
+        try:
+            for i, ky, search_term in terms:
+                if pool:
+                    result = pool.submit(download_term, arguments, options,
+                                         i, ky, search_term)
+                else:
+                    result = Future()
+                    try:
+                        result.set_result(download_term(
+                            arguments, options, i, ky, search_term))
+                    except PageUnavailable as e:
+                        result.set_exception(e)
+                pending.append((i, search_term, result))
+                if len(pending) >= term_workers:
+                    total_errors = total_errors + collect()
+
+            while pending:
+                total_errors = total_errors + collect()
+        finally:
+            if pool:
+                pool.shutdown(cancel_futures=True)
+
+        sprint('Connections: {opened} opened, {reused} reused, '
+               '{tls_resumed} TLS sessions resumed'.format(
+                   **self.engine.pool.stats()))
+        if self.store:
+            sprint('Image store: {} images saved, {} duplicates linked'.format(
+                   self.store.saved, self.store.deduplicated))
+        if work_queue:
+            counts = work_queue.counts()
+            sprint('Work queue: {} terms done, {} failed, {} leased, {} '
+                   'queued'.format(counts.get('done', 0),
+                                   counts.get('failed', 0),
+                                   counts.get('leased', 0),
+                                   counts.get('queued', 0)))
 
         return paths, total_errors
 
+    def near_duplicates(self, directory, distance=4, workers=None):
+        """Yield (path, original, distance) of the images of 'directory'
+        whose dhash is within 'distance' bits of the one of an earlier image
+
+        The images are hashed in batches by a pool of 'workers' processes,
+        in the sorted order of their paths and with a bounded number of
+        batches in flight. Only the first image of every group of near
+        duplicates is indexed. The thumbnail directories are left out, their
+        images being near duplicates by design."""
+        index = HashIndex(distance)
+        for path, key in self._image_hashes(directory, workers):
+            if key is None:
+                continue
+            found = index.search(key)
+            if found:
+                original, d = min(found, key=lambda match: match[1])
+                yield path, original, d
+            else:
+                index.add(key, path)
+
+    def _image_hashes(self, directory, workers=None, batch_size=256):
+        def image_paths():
+            # a directory is listed, and sorted, in full before its images
+            # are hashed, the hashes are what is computed in batches
+            for root, dirs, files in os.walk(directory):
+                dirs[:] = sorted(name for name in dirs
+                                 if not name.endswith(' - thumbnail'))
+                for name in sorted(files):
+                    extension = os.path.splitext(name)[1][1:].lower()
+                    if extension in EXTENSIONS or extension == 'jpeg':
+                        yield os.path.join(root, name)
+
+        paths = image_paths()
+        batches = iter(lambda: list(itertools.islice(paths, batch_size)), [])
+        workers = workers or os.cpu_count() or 1
+        if workers == 1:
+            for batch in batches:
+                yield from hash_images(batch)
+            return
+
+        with ProcessPoolExecutor(workers) as executor:
+            pending = deque()
+            for batch in batches:
+                pending.append(executor.submit(hash_images, batch))
+                if len(pending) >= workers * 2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def handle_near_duplicates(self, directory, action='report', distance=4,
+                               workers=None):
+        """Report the near duplicates of 'directory', delete them ('skip')
+        or hard link them to their original ('link'), returns their number
+
+        The manifest entries of the deleted images point to their original
+        instead."""
+        count = 0
+        for path, original, d in self.near_duplicates(directory, distance,
+                                                      workers):
+            count += 1
+            if action == 'report':
+                print('Near duplicate: {} of {} ({} bits apart)'.format(
+                      path, original, d))
+            elif action == 'skip':
+                os.remove(path)
+                if self.manifest:
+                    self.manifest.replaced(path, original)
+            elif not os.path.samefile(path, original):
+                # link under a temporary name first, to replace the file
+                link = path + '.link'
+                try:
+                    os.link(original, link)
+                except OSError:
+                    os.symlink(os.path.abspath(original), link)
+                os.replace(link, path)
+        sprint('Near duplicates: {} found'.format(count))
+        return count
+
+    def _download_leased(self, arguments, options, i, ky, search_term):
+        """Download a term leased from the work queue and record it there
+
+        A term whose download fails goes back in the queue, or is recorded
+        as failed after its last attempt, and counts as an error; the worker
+        goes on with the next term. A stopped download gives its term back."""
+        try:
+            abs_path, errorCount = self._download_term(arguments, options, i,
+                                                       ky, search_term)
+        except DownloadStopped:
+            self.work_queue.release(search_term)
+            raise
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+            if self.work_queue.fail(search_term, error):
+                print('Search term {} failed: {}'.format(search_term, error))
+            else:
+                print('Search term {} will be retried: {}'.format(
+                      search_term, error))
+            return [], 1
+        except BaseException:
+            self.work_queue.release(search_term)
+            raise
+        self.work_queue.complete(search_term, errorCount)
+        return abs_path, errorCount
+
+    def _download_term(self, arguments, options, i, ky, search_term):
+        """Search and download the images of a single search term"""
+        sprint(f'\nItem no.: {i+1} --> Item name = {search_term}\n'
+               'Evaluating...')
+
+        if arguments.image_directory:
+            dir_name = arguments.image_directory
+        elif arguments.no_directory:
+            dir_name = ''
+        else:
+            dir_name = search_term
+            if arguments.color:
+                # sub-directory
+                dir_name = '{}-{}'.format(dir_name,
+                                          arguments.color)
+
+        if not arguments.no_download:
+            # create directories in OS
+            self.create_directories(arguments.main_directory,
+                                    dir_name,
+                                    arguments.thumbnail,
+                                    arguments.thumbnail_only)
+
+        # building URL with params
+        params = self.build_url_parameters(options)
+
+        # building main search url
+        url = self.build_search_url(search_term, params,
+                                    arguments.url,
+                                    arguments.similar_images,
+                                    arguments.specific_site,
+                                    arguments.safe_search)
+
+        raw_html = self.download_page(url)  # download page
+
+        if arguments.no_download:
+            sprint('Getting URLs without downloading images...')
+        else:
+            sprint('Starting Download...')
+
+        # get all image items and download images, their metadata is
+        # streamed into a json lines file
+        metadata_path = None
+        if arguments.extract_metadata:
+            metadata_path = 'logs/{}.jsonl'.format(ky)
+        try:
+            items, errorCount, abs_path = self._get_all_items(
+                    raw_html, arguments.main_directory, dir_name,
+                    arguments.limit,
+                    options, search_term, metadata_path)
+        finally:
+            # there is a file for every term, they are not all kept open
+            if metadata_path:
+                self.writer.close_file(metadata_path)
+
+        # Related images
+        if arguments.related_images:
+            print('\nGetting list of related keywords...'
+                  'this may take a few moments')
+            tabs = self.get_all_tabs(raw_html)
+            for key, value in tabs.items():
+                final_search_term = '{}-{}'.format(search_term, key)
+                print('\nNow Downloading - ' + final_search_term)
+                try:
+                    new_raw_html = self.download_page(value)
+                except PageUnavailable as e:
+                    print('Skipping {}: {}'.format(final_search_term, e))
+                    errorCount += 1
+                    continue
+                self.create_directories(
+                        arguments.main_directory,
+                        final_search_term,
+                        arguments.thumbnail,
+                        arguments.thumbnail_only)
+                self._get_all_items(new_raw_html, arguments.main_directory,
+                                    search_term + ' - ' + key,
+                                    arguments.limit, options,
+                                    final_search_term)
+
+        sprint('\nErrors: ' + str(errorCount) + '\n')
+
+        return abs_path, errorCount
+
 
 # ------------ Main Program -------------#
+# limits meant for the whole run, shared out between the '--jobs' processes
+SHARED_LIMITS = ('rate', 'host_rate', 'bandwidth', 'search_rate')
+
+
+class RecordOutput(io.TextIOBase):
+    """Output of a record, passed on line by line to the queue printed by
+    the process spreading the records"""
+
+    def __init__(self, number, lines):
+        self.number = number
+        self.lines = lines
+        self.pending = ''
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        *done, self.pending = (self.pending + text).split('\n')
+        for line in done:
+            self.lines.put((self.number, line))
+        return len(text)
+
+    def close(self):
+        if self.pending:
+            self.lines.put((self.number, self.pending))
+            self.pending = ''
+        super().close()
+
+
+# queue of the output lines of the records, in the '--jobs' processes
+record_lines = None
+
+
+def use_record_lines(lines):
+    global record_lines
+    record_lines = lines
+
+
+def run_record(arguments, number):
+    """Run a single record in its own downloader
+
+    This is what the '--jobs' processes run. The output of the record goes
+    line by line to the queue of the process, tagged with 'number'. Returns
+    the errors and the seconds it took."""
+    errors = 0
+    start = time.time()
+    output = RecordOutput(number, record_lines)
+    with output, contextlib.redirect_stdout(output):
+        downloader = GoogleImagesDownloader()
+        try:
+            if arguments.single_image:
+                downloader.single_image(arguments.single_image)
+            else:
+                paths, errors = downloader.download(arguments)
+        except Exception:
+            traceback.print_exc(file=output)
+            errors += 1
+        finally:
+            downloader.close()
+
+    return errors, time.time() - start
+
+
+def print_record_lines(lines):
+    """Print the output lines of the records as they come, each starting
+    with the number of its record, until a None"""
+    for number, line in iter(lines.get, None):
+        sprint('[{}] {}'.format(number, line), flush=True)
+
+
+def run_records(records, jobs):
+    """Spread the records over 'jobs' processes, returns the total errors and
+    the seconds taken by the records altogether
+
+    The output of the records is printed as it comes, every line starting
+    with the number of its record. The rate limits hold for the whole run,
+    so each process gets its share, out of the records that can run at once.
+    Records are read as processes free up, so they may be streamed."""
+    total_errors = 0
+    total_time = 0
+    records = iter(records)
+    # with fewer records than processes, fewer of them share the limits
+    first = list(itertools.islice(records, jobs))
+    if not first:
+        return total_errors, total_time
+    jobs = len(first)
+    records = enumerate(itertools.chain(first, records), 1)
+
+    lines = multiprocessing.Queue()
+    printer = threading.Thread(target=print_record_lines, args=(lines,))
+    printer.start()
+    try:
+        with ProcessPoolExecutor(jobs, initializer=use_record_lines,
+                                 initargs=(lines,)) as executor:
+            futures = set()
+            while True:
+                # keep every process busy, with a record waiting for each
+                for number, arguments in itertools.islice(
+                        records, jobs * 2 - len(futures)):
+                    arguments = argparse.Namespace(**vars(arguments))
+                    for name in SHARED_LIMITS:
+                        if getattr(arguments, name):
+                            setattr(arguments, name,
+                                    getattr(arguments, name) / jobs)
+                    futures.add(executor.submit(run_record, arguments,
+                                                number))
+                if not futures:
+                    break
+
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    errors, elapsed = future.result()
+                    total_errors += errors
+                    total_time += elapsed
+    finally:
+        # the processes are gone, their lines all in the queue
+        lines.put(None)
+        printer.join()
+
+    return total_errors, total_time
+
+
 def main():
-    records = user_input()
+    records = iter(user_input())
     total_errors = 0
     t0 = time.time()
+    first = next(records, None)
+    if first is None:
+        print('Done')
+        return
+    records = itertools.chain([first], records)
+    jobs = first.jobs
+    if jobs > 1:
+        total_errors, records_time = run_records(records, jobs)
+        sprint('\nEverything downloaded!\nTotal errors: {}\nTotal time taken: '
+               '{} Seconds ({} Seconds across records)'.format(
+                   total_errors, int(time.time() - t0), int(records_time)))
+        print('Done')
+        return
+
+    # a single downloader, so that connections are reused across records
+    downloader = GoogleImagesDownloader()
     for arguments in records:
         if arguments.single_image:
-            downloader = GoogleImagesDownloader()
             downloader.single_image(arguments.single_image)
         else:
-            downloader = GoogleImagesDownloader()
             paths, errors = downloader.download(arguments)
             total_errors = total_errors + errors
 
@@ -1129,6 +4052,7 @@ def main():
         total_time = int(t1) - int(t0)
         sprint('\nEverything downloaded!\nTotal errors: {}\nTotal time taken: {} Seconds'.format(
                total_errors, total_time))
+    downloader.close()
     print('Done')
 
 
@@ -1,6 +1,20 @@
 from google_images_download import google_images_download
 import os, errno
+import asyncio
+import gc
+import io
+import json
+import random
+import sqlite3
+import subprocess
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+
+import pytest
 
 
 def silent_remove_of_file(file):
@@ -13,28 +27,29 @@ def silent_remove_of_file(file):
     return True
 
 
-def test_download_images_to_default_location():
+def test_download_images_to_default_location(stand_in_server, tmp_path,
+                                             monkeypatch):
     start_time = time.time()
-    argumnets = {
-        "keywords": "Polar bears",
-        "limit": 5,
-        "print_urls": False
-    }
-    try:
-        temp = argumnets['output_folder']
-    except KeyError:
-        pass
-    else:
-        assert False, "This test checks download to default location yet an output folder was provided"
+    # the search page is served by the local stand-in instead of Google
+    monkeypatch.chdir(tmp_path)
+    parser = google_images_download.get_parser()
+    argumnets = parser.parse_args(['--keywords', 'Polar bears',
+                                   '--limit', '5'])
+    assert argumnets.output_directory is None, "This test checks download to default location yet an output folder was provided"
+    argumnets.search_keyword = argumnets.keywords.split(',')
+    argumnets.main_directory = 'downloads'
 
-    output_folder_path = os.path.join(os.path.realpath('.'), 'downloads', '{}'.format(argumnets['keywords']))
+    output_folder_path = os.path.join(os.path.realpath('.'), 'downloads', '{}'.format(argumnets.keywords))
     if os.path.exists(output_folder_path):
         start_amount_of_files_in_output_folder = len([name for name in os.listdir(output_folder_path) if os.path.isfile(os.path.join(output_folder_path, name)) and os.path.getctime(os.path.join(output_folder_path, name)) < start_time])
     else:
         start_amount_of_files_in_output_folder = 0
 
-    response = google_images_download.googleimagesdownload()
+    response = google_images_download.GoogleImagesDownloader()
+    monkeypatch.setattr(response, 'build_search_url',
+                        lambda *args: stand_in_server + '/search')
     response.download(argumnets)
+    response.close()
     files_modified_after_test_started = [name for name in os.listdir(output_folder_path) if os.path.isfile(os.path.join(output_folder_path, name)) and os.path.getmtime(os.path.join(output_folder_path, name)) > start_time]
     end_amount_of_files_in_output_folder = len(files_modified_after_test_started)
     print(f"Files downloaded by test {__name__}:")
@@ -43,11 +58,1535 @@ def test_download_images_to_default_location():
 
 
     # assert end_amount_of_files_in_output_folder - start_amount_of_files_in_output_folder == argumnets['limit']
-    assert end_amount_of_files_in_output_folder == argumnets['limit']
+    assert end_amount_of_files_in_output_folder == argumnets.limit
 
     print(f"Cleaning up all files downloaded by test {__name__}...")
     for file in files_modified_after_test_started:
         if silent_remove_of_file(os.path.join(output_folder_path, file)):
             print(f"Deleted {os.path.join(output_folder_path, file)}")
         else:
-            print(f"Failed to delete {os.path.join(output_folder_path, file)}")
\ No newline at end of file
+            print(f"Failed to delete {os.path.join(output_folder_path, file)}")
+
+def make_html(urls):
+    """Build a result page in the 'rg_meta' format for the given urls"""
+    divs = []
+    for url in urls:
+        meta = {'pt': 'description', 'ity': 'jpg', 'oh': 10, 'ow': 10,
+                'rh': 'example.com', 'ou': url, 'ru': 'http://example.com/',
+                'tu': url + '?thumb'}
+        divs.append('<div class="rg_meta notranslate">{}</div>'.format(
+            json.dumps(meta)))
+    return ''.join(divs)
+
+
+def make_page(urls):
+    """Raw page content, as returned by 'download_page'"""
+    return str(make_html(urls).encode('utf-8'))
+
+
+def make_options(*argv):
+    parser = google_images_download.get_parser()
+    return vars(parser.parse_args(['--keywords', 'test'] + list(argv)))
+
+
+def fake_fetch(image_url, timeout, sink, phase='page'):
+    # finish out of order and fail for every url ending in a 3
+    time.sleep(random.random() / 50)
+    if image_url.endswith('3.jpg'):
+        raise URLError('unreachable')
+    sink.write(image_url.encode('utf-8'))
+    return sink
+
+
+def test_workers_keep_numbering_and_order(tmp_path, monkeypatch):
+    urls = ['http://example.com/{}.jpg'.format(i) for i in range(20)]
+    page = make_page(urls)
+    results = []
+    for workers in ('1', '4'):
+        main_directory = tmp_path / workers
+        (main_directory / 'test').mkdir(parents=True)
+        downloader = google_images_download.GoogleImagesDownloader()
+        downloader.use_engine('urllib', int(workers))
+        monkeypatch.setattr(downloader.engine, 'fetch', fake_fetch)
+        options = make_options('--workers', workers, '--offset', '2')
+        items, errors, abs_path = downloader._get_all_items(
+            page, str(main_directory), 'test', 10, options)
+        results.append(([item['image_filename'] for item in items], errors,
+                        [os.path.basename(path) for path in abs_path]))
+
+    assert results[0] == results[1]
+    assert not list(tmp_path.glob('*/test/.*.part'))
+    names, errors, _ = results[1]
+    assert names[0] == '2.1.jpg'
+    assert names[-1] == '10.10.jpg'
+    assert errors == 1
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves a result page at /search and a few bytes for every image"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_CONNECT(self):
+        self.server.proxied.append((self.path, self.headers['Host'],
+                                    self.headers['Proxy-Authorization']))
+        self.send_error(403)
+
+    def do_GET(self):
+        if self.path.startswith('http://'):
+            # asked as a proxy
+            self.server.proxied.append((self.path, self.headers['Host'],
+                                        self.headers['Proxy-Authorization']))
+            self.path = urlsplit(self.path).path
+        host = 'http://%s:%d' % self.server.server_address
+        self.server.hits.append(self.path)
+        if self.path == '/missing.jpg':
+            self.send_error(404)
+            return
+        if (self.path.startswith('/down') or self.path.startswith('/flaky')
+                and self.server.hits.count(self.path) == 1):
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path.startswith('/stall'):
+            time.sleep(0.6)
+        if self.path.startswith('/slow'):
+            # a piece of the body at a time, each well within a timeout
+            body = b'\xff\xd8\xff' + bytes(997)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            for i in range(0, len(body), 200):
+                self.wfile.write(body[i:i + 200])
+                self.wfile.flush()
+                time.sleep(0.15)
+            return
+        if self.path == '/moved.jpg':
+            self.send_response(302)
+            self.send_header('Location', '/0.jpg')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path == '/search':
+            urls = ['{}/{}.jpg'.format(host, i) for i in range(8)]
+            urls.insert(3, host + '/missing.jpg')
+            body = make_html(urls).encode('utf-8')
+        elif self.server.picture:
+            body = self.server.picture
+        elif 'big' in self.path:
+            body = b'\xff\xd8\xff' + bytes(1024 * 1024)
+        else:
+            body = b'\xff\xd8\xff' + self.path.encode('utf-8') * 100
+
+        self.send_response(200)
+        if 'octet' in self.path:
+            self.send_header('Content-Type', 'application/octet-stream')
+        else:
+            self.send_header('Content-Type', 'image/jpeg')
+        if self.path.startswith('/chunked'):
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in range(0, len(body), 64):
+                chunk = body[i:i + 64]
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+@pytest.fixture
+def stand_in():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.hits = []
+    server.proxied = []
+    # served for every image instead of a few bytes when set
+    server.picture = None
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def stand_in_server(stand_in):
+    return 'http://%s:%d' % stand_in.server_address
+
+
+@pytest.mark.parametrize('engine', ['urllib', 'asyncio'])
+def test_engine_fetch(stand_in_server, engine):
+    downloader = google_images_download.GoogleImagesDownloader()
+    downloader.use_engine(engine, 4)
+    try:
+        fetch = downloader.engine.fetch
+        assert fetch(stand_in_server + '/1.jpg') == b'\xff\xd8\xff' + b'/1.jpg' * 100
+        assert fetch(stand_in_server + '/chunked.jpg', 5) == (
+            b'\xff\xd8\xff' + b'/chunked.jpg' * 100)
+        assert fetch(stand_in_server + '/moved.jpg') == fetch(stand_in_server + '/0.jpg')
+        with pytest.raises(HTTPError) as e:
+            fetch(stand_in_server + '/missing.jpg')
+        assert e.value.code == 404
+    finally:
+        downloader.close()
+
+
+@pytest.mark.parametrize('engine', ['urllib', 'asyncio'])
+def test_engine_timeout_applies_to_each_read(stand_in_server, engine):
+    downloader = google_images_download.GoogleImagesDownloader()
+    downloader.use_engine(engine, 2)
+    try:
+        fetch = downloader.engine.fetch
+        # 0.75s in all, never 0.4s without a byte
+        assert len(fetch(stand_in_server + '/slow.jpg', 0.4)) == 1000
+        with pytest.raises(URLError):
+            fetch(stand_in_server + '/stall.jpg', 0.3)
+    finally:
+        downloader.close()
+
+
+@pytest.mark.parametrize('engine', ['urllib', 'asyncio'])
+def test_engine_uses_the_proxy_of_the_environment(stand_in, monkeypatch,
+                                                  engine):
+    monkeypatch.setenv('http_proxy', 'http://user:secret@%s:%d' %
+                       stand_in.server_address)
+    monkeypatch.setenv('https_proxy', 'http://%s:%d' %
+                       stand_in.server_address)
+    monkeypatch.setenv('no_proxy', 'direct.example')
+    downloader = google_images_download.GoogleImagesDownloader()
+    downloader.use_engine(engine, 2)
+    try:
+        fetch = downloader.engine.fetch
+        assert fetch('http://images.example/1.jpg') == (
+            b'\xff\xd8\xff' + b'/1.jpg' * 100)
+        # 'user:secret'
+        assert stand_in.proxied == [('http://images.example/1.jpg',
+                                     'images.example',
+                                     'Basic dXNlcjpzZWNyZXQ=')]
+        # https goes through a tunnel, refused here
+        with pytest.raises(URLError):
+            fetch('https://images.example/1.jpg', 2)
+        assert stand_in.proxied[1][0] == 'images.example:443'
+        with pytest.raises(URLError):
+            fetch('http://direct.example/1.jpg', 2)
+        assert len(stand_in.proxied) == 2
+    finally:
+        downloader.close()
+
+
+def test_engines_return_the_same_result(stand_in_server, tmp_path):
+    results = []
+    for engine in ('urllib', 'asyncio'):
+        parser = google_images_download.get_parser()
+        arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                       '--limit', '5', '--workers', '3',
+                                       '--engine', engine])
+        arguments.search_keyword = ['test']
+        arguments.main_directory = str(tmp_path / engine)
+        downloader = google_images_download.GoogleImagesDownloader()
+        paths, errors = downloader.download(arguments)
+        downloader.close()
+        results.append(({term: [os.path.relpath(path, arguments.main_directory)
+                                for path in term_paths]
+                         for term, term_paths in paths.items()}, errors))
+
+    assert results[0] == results[1]
+    paths, errors = results[0]
+    assert errors == 1
+    assert len(list(paths.values())[0]) == 5
+
+
+@pytest.mark.parametrize('engine', ['urllib', 'asyncio'])
+def test_engine_reuses_connections(stand_in_server, engine):
+    downloader = google_images_download.GoogleImagesDownloader()
+    for idle_timeout in (30, 0):
+        downloader.use_engine(engine, 1, idle_timeout=idle_timeout)
+        for i in range(5):
+            downloader.engine.fetch('{}/{}.jpg'.format(stand_in_server, i))
+        time.sleep(0.01)
+        downloader.engine.fetch(stand_in_server + '/chunked.jpg')
+        stats = downloader.engine.pool.stats()
+        if idle_timeout:
+            assert stats['opened'] == 1
+            assert stats['reused'] == 5
+        else:
+            assert stats['opened'] == 6
+            assert stats['reused'] == 0
+    downloader.close()
+
+
+class ChunkSink:
+    def __init__(self):
+        self.chunks = []
+
+    @property
+    def size(self):
+        return sum(self.chunks)
+
+    def start(self, headers):
+        pass
+
+    def write(self, chunk):
+        self.chunks.append(len(chunk))
+
+    def reset(self):
+        self.chunks = []
+
+
+@pytest.mark.parametrize('engine', ['urllib', 'asyncio'])
+def test_engine_streams_to_sink(stand_in_server, engine):
+    downloader = google_images_download.GoogleImagesDownloader()
+    downloader.use_engine(engine)
+    for path in ('/big.jpg', '/chunked-big.jpg'):
+        sink = ChunkSink()
+        assert downloader.engine.fetch(stand_in_server + path, 5, sink) is sink
+        assert sum(sink.chunks) == 1024 * 1024 + 3
+        assert max(sink.chunks) <= google_images_download.CHUNK_SIZE
+    downloader.close()
+
+
+def test_iter_items_walks_the_page_once():
+    urls = ['http://example.com/{}.jpg'.format(i) for i in range(3)]
+    page = make_page(urls[:1]) + 'garbage</div>' + make_page(urls[1:])
+    downloader = google_images_download.GoogleImagesDownloader()
+    items = [downloader._decode_item(raw)
+             for raw in downloader._iter_items(page)]
+    assert [item['ou'] for item in items] == urls
+    assert list(downloader._iter_items('<html>no results</html>')) == []
+
+
+def test_offset_skips_without_decoding(tmp_path, monkeypatch):
+    downloader = google_images_download.GoogleImagesDownloader()
+    decoded = []
+    decode_item = downloader._decode_item
+    monkeypatch.setattr(downloader, '_decode_item',
+                        lambda raw: decoded.append(raw) or decode_item(raw))
+    urls = ['http://example.com/{}.jpg'.format(i) for i in range(10)]
+    items, errors, abs_path = downloader._get_all_items(
+        make_page(urls), str(tmp_path), 'test', 7,
+        make_options('--offset', '5', '--no_download'))
+    assert [item['image_link'] for item in items] == urls[4:7]
+    assert len(decoded) == 3
+
+
+def test_get_all_tabs():
+    tab = ('<a class="dtviD" href="/search?q=polar+bears&amp;tbm=isch&amp;'
+           'chips=q:polar+bears,g_1:{}&amp;usg=AI4&amp;sa=X">x</a>')
+    page = str((tab.format('baby') + tab.format('arctic+sea') +
+                make_html(['http://example.com/a.jpg'])).encode('utf-8'))
+    downloader = google_images_download.GoogleImagesDownloader()
+    tabs = downloader.get_all_tabs(page)
+    assert list(tabs) == ['baby', 'arctic sea']
+    assert tabs['baby'] == ('https://www.google.com/search?q=polar+bears&'
+                            'tbm=isch&chips=q:polar+bears,g_1:baby&usg=AI4&'
+                            'sa=X')
+    assert downloader.get_all_tabs(page.replace('href', 'src')) == {}
+
+
+def test_dedupe_store_links_duplicates(stand_in_server, tmp_path):
+    parser = google_images_download.get_parser()
+    arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                   '--limit', '3',
+                                   '--dedupe_store', str(tmp_path / 'store')])
+    arguments.search_keyword = ['first', 'second']
+    arguments.main_directory = str(tmp_path / 'downloads')
+    downloader = google_images_download.GoogleImagesDownloader()
+    paths, errors = downloader.download(arguments)
+    downloader.close()
+
+    first, second = paths.values()
+    assert len(first) == len(second) == 3
+    for path, duplicate in zip(first, second):
+        assert os.path.samefile(path, duplicate)
+
+    stored = [path for path in (tmp_path / 'store').glob('*/*')]
+    assert len(stored) == 3
+    index = sqlite3.connect(str(tmp_path / 'store' / 'index.sqlite'))
+    refs = index.execute('SELECT digest, COUNT(DISTINCT search_term) '
+                         'FROM refs GROUP BY digest').fetchall()
+    index.close()
+    assert sorted(refs) == sorted((path.name, 2) for path in stored)
+
+
+def test_dedupe_store_on_another_file_system(stand_in_server, tmp_path,
+                                            monkeypatch):
+    store = str(tmp_path / 'store')
+
+    def device(path):
+        return os.path.abspath(path).startswith(store)
+
+    def cross_device(call):
+        def checked(src, dst, *args, **kwargs):
+            if device(src) != device(dst):
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            return call(src, dst, *args, **kwargs)
+        return checked
+
+    monkeypatch.setattr(google_images_download.os, 'replace',
+                        cross_device(os.replace))
+    monkeypatch.setattr(google_images_download.os, 'link',
+                        cross_device(os.link))
+    parser = google_images_download.get_parser()
+    arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                   '--limit', '3', '--dedupe_store', store])
+    arguments.search_keyword = ['test']
+    arguments.main_directory = str(tmp_path / 'downloads')
+    downloader = google_images_download.GoogleImagesDownloader()
+    paths, errors = downloader.download(arguments)
+    downloader.close()
+
+    assert errors == 0
+    assert len(paths['test']) == 3
+    for path in paths['test']:
+        assert os.path.islink(path)
+        assert device(os.path.realpath(path))
+
+
+def test_resume_skips_completed_images(stand_in, stand_in_server, tmp_path):
+    def run(*argv):
+        parser = google_images_download.get_parser()
+        arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                       '--limit', '4'] + list(argv))
+        arguments.search_keyword = ['test']
+        arguments.main_directory = str(tmp_path)
+        downloader = google_images_download.GoogleImagesDownloader()
+        paths, errors = downloader.download(arguments)
+        downloader.close()
+        return paths
+
+    first = run('--manifest', str(tmp_path / 'manifest.sqlite'))
+    assert len(stand_in.hits) == 6
+
+    # pretend the run was interrupted while the last image was written
+    manifest = sqlite3.connect(str(tmp_path / 'manifest.sqlite'))
+    partial = tmp_path / 'test' / '.interrupted.part'
+    partial.write_bytes(b'\xff\xd8')
+    manifest.execute("UPDATE images SET status = 'started', path = ? "
+                     "WHERE url LIKE '%/2.jpg'", (str(partial),))
+    manifest.commit()
+    manifest.close()
+
+    del stand_in.hits[:]
+    # the manifest defaults to manifest.sqlite in the output directory
+    assert run('--resume') == first
+    assert stand_in.hits == ['/search', '/2.jpg', '/missing.jpg']
+    assert not partial.exists()
+
+
+def test_manifest_is_opened_once_per_downloader(stand_in, stand_in_server,
+                                                tmp_path, monkeypatch):
+    opened = []
+    Manifest = google_images_download.Manifest
+
+    def manifest(path, resume=False):
+        opened.append(path)
+        return Manifest(path, resume)
+
+    monkeypatch.setattr(google_images_download, 'Manifest', manifest)
+    downloader = google_images_download.GoogleImagesDownloader()
+    for keyword in ('cats', 'dogs', 'cats'):
+        parser = google_images_download.get_parser()
+        arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                       '--limit', '2', '--resume'])
+        arguments.search_keyword = [keyword]
+        arguments.main_directory = str(tmp_path)
+        del stand_in.hits[:]
+        downloader.download(arguments)
+    # the images of the first record are still known to the third one
+    assert stand_in.hits == ['/search']
+    assert opened == [str(tmp_path / 'manifest.sqlite')]
+    downloader.close()
+    assert downloader.manifests == {}
+
+
+def test_page_cache(stand_in, stand_in_server, tmp_path):
+    def run(*argv):
+        parser = google_images_download.get_parser()
+        arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                       '--limit', '2', '--cache_dir',
+                                       str(tmp_path / 'cache')] + list(argv))
+        arguments.search_keyword = ['test']
+        arguments.main_directory = str(tmp_path / 'downloads')
+        downloader = google_images_download.GoogleImagesDownloader()
+        paths, errors = downloader.download(arguments)
+        downloader.close()
+        return paths
+
+    run()
+    run('--offset', '2')
+    assert stand_in.hits.count('/search') == 1
+    run('--cache_ttl', '0')
+    assert stand_in.hits.count('/search') == 2
+
+    del stand_in.hits[:]
+    # images are not downloaded either, only their urls are returned
+    assert run('--cache_only') == {'test': [stand_in_server + '/0.jpg',
+                                              stand_in_server + '/1.jpg']}
+    assert stand_in.hits == []
+
+    cache = google_images_download.PageCache(str(tmp_path / 'small'),
+                                             max_size=35)
+    for i in range(3):
+        cache.put('http://example.com/%d' % i, b'0123456789')
+        time.sleep(0.01)
+    cache.get('http://example.com/0')
+    for i in range(3, 5):
+        time.sleep(0.01)
+        cache.put('http://example.com/%d' % i, b'0123456789')
+    cached = [i for i in range(5) if cache.get('http://example.com/%d' % i)]
+    assert cached == [0, 3, 4]
+
+
+def test_term_workers_aggregate_results(stand_in_server, tmp_path):
+    results = []
+    for term_workers in ('1', '3'):
+        parser = google_images_download.get_parser()
+        arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                       '--limit', '4', '--workers', '2',
+                                       '--prefix_keywords', 'red,blue',
+                                       '--term_workers', term_workers])
+        arguments.search_keyword = ['car', 'bike']
+        arguments.main_directory = str(tmp_path / term_workers)
+        downloader = google_images_download.GoogleImagesDownloader()
+        paths, errors = downloader.download(arguments)
+        downloader.close()
+        results.append(({term: [os.path.relpath(path, arguments.main_directory)
+                                for path in term_paths]
+                         for term, term_paths in paths.items()}, errors))
+
+    assert results[0] == results[1]
+    paths, errors = results[1]
+    assert list(paths) == ['red car', 'red bike', 'blue car', 'blue bike']
+    assert errors == 4
+
+
+def test_token_bucket_fractional_rate(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(google_images_download.time, 'monotonic',
+                        lambda: now[0])
+    bucket = google_images_download.TokenBucket(0.5)
+    assert [bucket.reserve() for _ in range(3)] == [0, 2, 4]
+    now[0] += 10
+    assert bucket.reserve() == 0
+
+
+@pytest.mark.parametrize('engine', ['urllib', 'asyncio'])
+def test_engine_rate_limits(stand_in_server, engine):
+    downloader = google_images_download.GoogleImagesDownloader()
+    downloader.use_engine(engine, 4)
+    downloader.engine.limiter = google_images_download.RateLimiter(
+        host_rate=4, bandwidth=512 * 1024)
+    start = time.monotonic()
+    futures = [downloader.engine.submit('{}/{}.jpg'.format(stand_in_server, i),
+                                        5, ChunkSink()) for i in range(5)]
+    futures.append(downloader.engine.submit(stand_in_server + '/big.jpg', 5,
+                                            ChunkSink()))
+    for future in futures:
+        future.result()
+    # the burst holds one second worth: 2 requests and 512 KB too many
+    assert time.monotonic() - start >= 0.5
+    downloader.close()
+
+
+@pytest.mark.parametrize('engine', ['urllib', 'asyncio'])
+def test_rate_limit_waits_do_not_count_against_the_timeout(stand_in_server,
+                                                           engine):
+    downloader = google_images_download.GoogleImagesDownloader()
+    downloader.use_engine(engine, 4)
+    downloader.engine.limiter = google_images_download.RateLimiter(rate=2)
+    # the last requests wait over a second for their token
+    futures = [downloader.engine.submit('{}/{}.jpg'.format(stand_in_server, i),
+                                        1, ChunkSink()) for i in range(6)]
+    try:
+        assert [future.result().size for future in futures] == [
+            603, 603, 603, 603, 603, 603]
+    finally:
+        downloader.close()
+
+
+@pytest.mark.parametrize('engine', ['urllib', 'asyncio'])
+def test_engine_retries_and_breaks_circuits(stand_in, stand_in_server,
+                                            engine):
+    downloader = google_images_download.GoogleImagesDownloader()
+    downloader.use_engine(engine)
+    downloader.engine.retry = google_images_download.RetryPolicy(
+        2, 0.01, threshold=4, cooldown=0.2)
+    fetch = downloader.engine.fetch
+    try:
+        assert sum(fetch(stand_in_server + '/flaky.jpg', 5,
+                         ChunkSink()).chunks) == 3 + len('/flaky.jpg') * 100
+        with pytest.raises(HTTPError):
+            fetch(stand_in_server + '/missing.jpg')
+        assert stand_in.hits == ['/flaky.jpg'] * 2 + ['/missing.jpg']
+
+        with pytest.raises(HTTPError) as e:
+            fetch(stand_in_server + '/down.jpg')
+        assert e.value.code == 503
+        # the 4th failure in a row opens the circuit, without a retry
+        with pytest.raises(HTTPError):
+            fetch(stand_in_server + '/down.jpg')
+        with pytest.raises(google_images_download.HostUnavailable):
+            fetch(stand_in_server + '/0.jpg')
+        assert stand_in.hits.count('/down.jpg') == 4
+
+        time.sleep(0.2)
+        fetch(stand_in_server + '/0.jpg')
+        fetch(stand_in_server + '/1.jpg')
+    finally:
+        downloader.close()
+
+
+def test_abandoned_asyncio_failures_are_not_reported():
+    engine = google_images_download.AsyncioEngine(2)
+    reported = []
+    engine.loop.set_exception_handler(
+        lambda loop, context: reported.append(context))
+
+    async def failing(url, timeout, sink):
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            # as 'wait_for' does when a read completes along with the
+            # cancellation
+            pass
+        raise HTTPError(url, 500, 'Internal Server Error', {}, None)
+
+    engine._get = failing
+    future = engine.submit('http://example.com/0.jpg', 5, None, 'image')
+    time.sleep(0.05)
+    # the image is abandoned while it is downloaded
+    future.cancel()
+    time.sleep(0.05)
+    # the failure would be reported once its task is collected
+    del future
+    gc.collect()
+    engine.close()
+    assert reported == []
+
+
+def test_retry_after():
+    policy = google_images_download.RetryPolicy(max_backoff=10)
+    error = HTTPError('http://example.com/', 429, 'Too Many Requests',
+                      {'Retry-After': '3'}, None)
+    assert policy.failed('http://example.com/', 0, error) == 3
+    error.headers = {'Retry-After': '60'}
+    assert policy.failed('http://example.com/', 0, error) is None
+    assert 0.25 <= policy.failed('http://example.com/', 0, URLError('x')) <= 0.5
+
+
+def test_run_records_across_processes(stand_in_server, tmp_path, capsys):
+    records = []
+    for i in range(3):
+        parser = google_images_download.get_parser()
+        arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                       '--limit', '4', '--rate', '30'])
+        arguments.search_keyword = ['record%d' % i]
+        arguments.main_directory = str(tmp_path / ('record%d' % i))
+        records.append(arguments)
+
+    errors, _ = google_images_download.run_records(records, 2)
+    assert errors == 3
+    assert records[0].rate == 30
+    for i in range(3):
+        assert len(list((tmp_path / ('record%d' % i)).glob('*/*.jpg'))) == 4
+
+    # every line of output starts with the number of its record
+    lines = capsys.readouterr().out.splitlines()
+    assert lines and all(line[:4] in ('[1] ', '[2] ', '[3] ')
+                         for line in lines)
+    for i in range(3):
+        record = [line for line in lines if line.startswith('[%d]' % (i + 1))]
+        assert sum('Item no.' in line for line in record) == 1
+        assert any('record%d' % i in line for line in record)
+
+
+def test_run_records_share_the_limits(monkeypatch):
+    rates = []
+
+    def run_record(arguments, number):
+        rates.append(arguments.rate)
+        return 0, 0
+
+    monkeypatch.setattr(google_images_download, 'ProcessPoolExecutor',
+                        ThreadPoolExecutor)
+    monkeypatch.setattr(google_images_download, 'run_record', run_record)
+    parser = google_images_download.get_parser()
+    arguments = parser.parse_args(['--keywords', 'x', '--rate', '4'])
+
+    # a single record has the whole rate, even with more processes
+    google_images_download.run_records(iter([arguments]), 4)
+    assert rates == [4]
+    # as many processes as records share it out
+    google_images_download.run_records(iter([arguments] * 6), 2)
+    assert rates[1:] == [2] * 6
+
+
+@pytest.mark.parametrize('engine', ['urllib', 'asyncio'])
+def test_unwanted_images_stop_early(stand_in, stand_in_server, tmp_path,
+                                    engine):
+    downloader = google_images_download.GoogleImagesDownloader()
+    downloader.use_engine(engine)
+
+    def download(url, image_format):
+        return downloader.download_image(
+            stand_in_server + url, image_format, str(tmp_path), 'test', 1,
+            False, 5, None, False, False, False, None, '', False, False,
+            'png', None)
+
+    (tmp_path / 'test').mkdir()
+    try:
+        # the metadata already tells, nothing is requested
+        assert download('/0.jpg', 'jpg')[:2] == (
+            'fail', 'Wrong image format returned. Skipping...')
+        assert stand_in.hits == []
+        # so does the Content-Type, then the first bytes
+        for url, reason in (('/big.png', 'Content-Type image/jpeg'),
+                            ('/octet-big.png', 'content of a jpg image')):
+            assert download(url, 'png')[:2] == (
+                'fail', 'Wrong image format returned ({}). Skipping...'.format(
+                    reason))
+            partial = google_images_download.PartialFile(str(tmp_path),
+                                                         image_format='png')
+            with pytest.raises(google_images_download.UnwantedImage):
+                downloader.engine.fetch(stand_in_server + url, 5, partial)
+            assert partial.size == 0
+            partial.discard()
+        assert stand_in.hits == ['/big.png', '/big.png', '/octet-big.png',
+                                 '/octet-big.png']
+        assert os.listdir(tmp_path / 'test') == []
+    finally:
+        downloader.close()
+
+
+@pytest.mark.parametrize('engine', ['urllib', 'asyncio'])
+def test_size_limits(stand_in, stand_in_server, tmp_path, engine):
+    downloader = google_images_download.GoogleImagesDownloader()
+    downloader.use_engine(engine, 2)
+    downloader.byte_limits = (100, 64 * 1024)
+    try:
+        # over the Content-Length, then over the streamed bytes
+        for url in ('/big.jpg', '/chunked-big.jpg'):
+            partial = google_images_download.PartialFile(str(tmp_path),
+                                                         max_bytes=64 * 1024)
+            with pytest.raises(google_images_download.UnwantedImage):
+                downloader.engine.fetch(stand_in_server + url, 5, partial)
+            assert partial.size <= 64 * 1024
+            partial.discard()
+
+        page = make_page(['{}/{}.jpg'.format(stand_in_server, i)
+                          for i in range(6)] + [stand_in_server + '/big.jpg'])
+        # the last image is filtered by its pixels, before any request
+        page = page.replace('"oh": 10', '"oh": 20', 1)
+        options = make_options('--workers', '2', '--min_pixels', '50',
+                               '--max_pixels', '150')
+        (tmp_path / 'test').mkdir()
+        items, errors, _ = downloader._get_all_items(
+            page, str(tmp_path), 'test', 6, options)
+    finally:
+        downloader.close()
+
+    # '/0.jpg' has too many pixels and '/big.jpg' too many bytes, neither
+    # takes a number
+    assert [item['image_filename'] for item in items] == [
+        '{0}.{0}.jpg'.format(i) for i in range(1, 6)]
+    assert errors == 2
+    assert not list(tmp_path.glob('test/.*.part'))
+    assert '/0.jpg' not in stand_in.hits
+
+
+@pytest.mark.parametrize('mode', ['--thumbnail', '--thumbnail_only'])
+def test_thumbnails_fetched_with_images(stand_in, stand_in_server, tmp_path,
+                                        mode):
+    urls = ['{}/{}.jpg'.format(stand_in_server, i) for i in range(6)]
+    urls.insert(2, stand_in_server + '/missing.jpg')
+    page = make_page(urls)
+    results = []
+    for workers in ('1', '3'):
+        main_directory = tmp_path / workers
+        (main_directory / 'test').mkdir(parents=True)
+        (main_directory / 'test - thumbnail').mkdir()
+        downloader = google_images_download.GoogleImagesDownloader()
+        downloader.use_engine('urllib', int(workers))
+        options = make_options('--workers', workers, mode)
+        items, errors, _ = downloader._get_all_items(
+            page, str(main_directory), 'test', 5, options)
+        downloader.close()
+        thumbnails = {path.name: path.read_bytes() for path in
+                      (main_directory / 'test - thumbnail').iterdir()}
+        results.append(([item['image_filename'] for item in items], errors,
+                        thumbnails))
+
+    assert results[0] == results[1]
+    names, errors, thumbnails = results[1]
+    assert sorted(thumbnails) == sorted(names)
+    if mode == '--thumbnail':
+        # the thumbnail is named after the image it goes with
+        assert names[2] == '3.2.jpg'
+        assert thumbnails['3.2.jpg'].endswith(b'/2.jpg?thumb')
+        assert errors == 1
+    else:
+        assert '/missing.jpg' not in stand_in.hits
+        assert len(names) == 5
+
+
+def test_save_source_and_metadata_lines(stand_in_server, tmp_path,
+                                        monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parser = google_images_download.get_parser()
+    arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                   '--limit', '4', '--workers', '3',
+                                   '--term_workers', '2', '--thumbnail',
+                                   '--save_source', 'sources',
+                                   '--extract_metadata'])
+    arguments.search_keyword = ['cats', 'dogs']
+    arguments.main_directory = 'downloads'
+    downloader = google_images_download.GoogleImagesDownloader()
+    closed = []
+    close_file = downloader.writer.close_file
+
+    def close_metadata(path):
+        closed.append(path)
+        close_file(path)
+
+    downloader.writer.close_file = close_metadata
+    downloader.download(arguments)
+
+    # the metadata of a term is closed once the term is done, the rest once
+    # the download is over
+    assert sorted(closed) == ['logs/cats.jsonl', 'logs/dogs.jsonl']
+    assert downloader.writer.files == {}
+    lines = (tmp_path / 'downloads' / 'sources.txt').read_text().splitlines()
+    assert len(lines) == 16
+    assert all(line.endswith('\thttp://example.com/') for line in lines)
+    for ky in ('cats', 'dogs'):
+        with open('logs/{}.jsonl'.format(ky)) as fh:
+            items = [json.loads(line) for line in fh]
+        assert [item['image_filename'] for item in items] == [
+            '1.0.jpg', '2.1.jpg', '3.2.jpg', '4.3.jpg']
+
+    # a new run starts the metadata over
+    downloader.download(arguments)
+    downloader.close()
+    with open('logs/cats.jsonl') as fh:
+        assert len(fh.readlines()) == 4
+
+
+def test_metadata_of_terms_sharing_a_keyword(stand_in_server, tmp_path,
+                                             monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parser = google_images_download.get_parser()
+    arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                   '--limit', '4', '--prefix_keywords',
+                                   'red,blue', '--term_workers', '2',
+                                   '--delay', '0.05', '--extract_metadata'])
+    arguments.search_keyword = ['car']
+    arguments.main_directory = 'downloads'
+    downloader = google_images_download.GoogleImagesDownloader()
+    for _ in range(2):
+        downloader.download(arguments)
+        # both terms, running at once, write to the file of their keyword,
+        # started over by every download
+        with open('logs/car.jsonl') as fh:
+            items = [json.loads(line) for line in fh]
+        assert sorted(item['image_filename'] for item in items) == sorted(
+            ['1.0.jpg', '2.1.jpg', '3.2.jpg', '4.3.jpg'] * 2)
+    downloader.close()
+
+
+def test_stats_report(stand_in_server, tmp_path):
+    measurements = []
+    downloader = google_images_download.GoogleImagesDownloader(
+        lambda *measurement: measurements.append(measurement))
+    parser = google_images_download.get_parser()
+    stats_json = tmp_path / 'stats.json'
+    arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                   '--limit', '4', '--workers', '2',
+                                   '--engine', 'asyncio', '--thumbnail',
+                                   '--stats_json', str(stats_json)])
+    arguments.search_keyword = ['test']
+    arguments.main_directory = str(tmp_path)
+    downloader.download(arguments)
+
+    with open(stats_json) as fh:
+        report = json.load(fh)
+    phases = report['phases']
+    assert phases['page']['count'] == 1
+    assert phases['image'] == dict(phases['image'], count=5, errors=1)
+    assert phases['image']['bytes'] == sum(
+        3 + len('/{}.jpg'.format(i)) * 100 for i in range(4))
+    # the thumbnail of the missing image is fetched along with it
+    assert phases['thumbnail']['count'] == 5
+    assert phases['disk']['count'] == 8
+    assert phases['parse']['count'] == 5
+    assert phases['directories']['count'] == 1
+    for summary in phases.values():
+        assert summary['p50'] <= summary['p95'] <= summary['p99']
+    assert report['hosts']['127.0.0.1']['image']['count'] == 5
+    assert len(measurements) == sum(summary['count']
+                                    for summary in phases.values())
+    images = [measurement for measurement in measurements
+              if measurement[0] == 'image']
+    for phase, host, seconds, size, failed in images:
+        assert host == '127.0.0.1'
+        assert seconds >= 0
+    assert sum(measurement[3] for measurement in images) == \
+        phases['image']['bytes']
+    assert sum(measurement[4] for measurement in images) == 1
+    assert [measurement[1] for measurement in measurements
+            if measurement[0] == 'parse'] == [None] * 5
+
+    # another download starts its statistics over
+    downloader.download(arguments)
+    downloader.close()
+    with open(stats_json) as fh:
+        assert json.load(fh)['phases']['image']['count'] == 5
+
+
+def test_stats_percentiles():
+    stats = google_images_download.Stats()
+    for i in range(1, 101):
+        stats.record('image', i / 100, 'example.com', 10)
+    summary = stats.report()['phases']['image']
+    assert summary['count'] == 100
+    assert summary['bytes'] == 1000
+    assert 0.5 <= summary['p50'] <= 0.55
+    assert 0.95 <= summary['p95'] <= 1.05
+    assert 0.99 <= summary['p99'] <= 1.09
+
+
+def test_iter_download(stand_in, stand_in_server, tmp_path):
+    parser = google_images_download.get_parser()
+    arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                   '--limit', '4', '--workers', '2'])
+    arguments.search_keyword = ['test']
+    arguments.main_directory = str(tmp_path)
+    downloader = google_images_download.GoogleImagesDownloader()
+    results = list(downloader.iter_download(arguments))
+
+    assert [result.status for result in results] == [
+        'success', 'success', 'success', 'fail', 'success']
+    assert results[3].url == stand_in_server + '/missing.jpg'
+    assert results[3].path is None
+    first = results[0]
+    assert first.search_term == 'test'
+    assert first.format == 'jpg'
+    assert first.bytes == os.path.getsize(first.path) == 3 + 600
+    assert first.seconds > 0
+    assert first.metadata['image_link'] == first.url
+
+    # stopping early stops the download
+    hits = len(stand_in.hits)
+    arguments.limit = 8
+    arguments.main_directory = str(tmp_path / 'stopped')
+    for result in downloader.iter_download(arguments, buffer=1):
+        break
+    time.sleep(0.1)
+    assert len(stand_in.hits) - hits < 8
+    assert downloader.image_callback is None
+    downloader.close()
+
+
+def test_format_goes_along_with_the_search(stand_in, stand_in_server,
+                                           tmp_path, monkeypatch):
+    monkeypatch.setattr('sys.argv', ['googleimagesdownload',
+                                     '--url', stand_in_server + '/search',
+                                     '--limit', '4', '--format', 'png',
+                                     '--output_directory', str(tmp_path)])
+    arguments, = google_images_download.user_input()
+    assert arguments.format == 'png'
+    downloader = google_images_download.GoogleImagesDownloader()
+    paths, errors = downloader.download(arguments)
+    downloader.close()
+    # the results are all jpg images, none of them is fetched
+    assert stand_in.hits == ['/search']
+    assert errors == 9
+
+    schema = google_images_download.ConfigSchema(
+        google_images_download.get_parser())
+    assert schema.namespace({'keywords': 'cats', 'format': 'gif'}).format == \
+        'gif'
+
+
+def test_config_schema_matches_the_parser():
+    parser = google_images_download.get_parser()
+    schema = google_images_download.ConfigSchema(parser)
+    record = {'keywords': ['polar bears', 'balloons'], 'limit': '5',
+              'thumbnail': True, 'print_urls': False, 'delay': 0.5,
+              'color': 'red', 'workers': 4}
+    expected = parser.parse_args(['--keywords=polar bears,balloons',
+                                  '--limit=5', '--thumbnail', '--delay=0.5',
+                                  '--color=red', '--workers=4'])
+    assert schema.namespace(record) == expected
+
+    with pytest.raises(ValueError) as e:
+        schema.namespace({'keywords': 'cats', 'url': 'http://example.com/',
+                          'limit': 2.5, 'color': 'plaid',
+                          'thumbnail': 'yes', 'colour': 'red'})
+    problems = str(e.value).split('; ')
+    assert len(problems) == 5
+    assert 'unrecognized argument: colour' in problems
+    assert 'arguments --keywords, --url are not allowed together' in problems
+    with pytest.raises(ValueError) as e:
+        schema.namespace({'limit': 5})
+    assert 'is required' in str(e.value)
+
+
+@pytest.mark.parametrize('extension', ['.json', '.jsonl'])
+def test_user_input_reports_every_invalid_record(tmp_path, monkeypatch,
+                                                 capsys, extension):
+    records = [{'keywords': 'cats', 'limit': 5},
+               {'keywords': 'dogs', 'limit': 'many'},
+               {'keywords': 'birds', 'jobs': 2},
+               {'keywords': 'fish', 'safe_search': 'on'}]
+    config = tmp_path / ('config' + extension)
+    if extension == '.json':
+        config.write_text(json.dumps({'Records': records}))
+    else:
+        config.write_text(''.join(json.dumps(record) + '\n'
+                                  for record in records))
+    monkeypatch.setattr('sys.argv', ['googleimagesdownload',
+                                     '--config_file', str(config)])
+    with pytest.raises(SystemExit):
+        google_images_download.user_input()
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split(':')[0] for line in lines] == [
+        'Config 1 invalid', 'Config 3 invalid']
+
+    del records[1:]
+    records.append({'keywords': 'birds', 'jobs': 5})
+    if extension == '.json':
+        config.write_text(json.dumps({'Records': records}))
+    else:
+        config.write_text(''.join(json.dumps(record) + '\n'
+                                  for record in records))
+    monkeypatch.setattr('sys.argv', ['googleimagesdownload', '--jobs', '3',
+                                     '--config_file', str(config)])
+    loaded = list(google_images_download.user_input())
+    assert [record.search_keyword for record in loaded] == [['cats'],
+                                                            ['birds']]
+    # --jobs comes from the command line
+    assert [record.jobs for record in loaded] == [3, 3]
+    assert loaded[0].main_directory == 'downloads'
+
+
+def test_user_input_reports_lines_that_are_not_json(tmp_path, monkeypatch,
+                                                    capsys):
+    config = tmp_path / 'config.jsonl'
+    config.write_text('{"keywords": "cats"}\n{"keywords": "dogs",\n'
+                      '{"limit": "many"}\n[1, 2\n')
+    monkeypatch.setattr('sys.argv', ['googleimagesdownload',
+                                     '--config_file', str(config)])
+    with pytest.raises(SystemExit):
+        google_images_download.user_input()
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split(':')[0] for line in lines] == [
+        'Config 1 invalid', 'Config 2 invalid', 'Config 3 invalid']
+    assert 'invalid JSON' in lines[0]
+
+
+def test_keyword_file_resumes_from_checkpoint(tmp_path):
+    keywords = tmp_path / 'keywords.txt'
+    keywords.write_bytes('\ufeffcats\r\n\ndogs\ncats\nbirds\n \ndogs\nfish'
+                         .encode('utf-8'))
+    checkpoint = str(tmp_path / 'out' / 'keywords.txt.checkpoint')
+    source = google_images_download.KeywordFile(str(keywords), checkpoint)
+    entries = source.entries()
+    assert [next(entries), next(entries)] == [(0, 'cats'), (2, 'dogs')]
+    source.completed(0)
+    source.completed(2)
+    entries.close()
+    with open(checkpoint) as fh:
+        assert json.load(fh)['line'] == 3
+
+    # the repeats of the lines before the checkpoint are still skipped
+    resumed = google_images_download.KeywordFile(str(keywords), checkpoint,
+                                                 resume=True)
+    assert list(resumed.entries()) == [(4, 'birds'), (7, 'fish')]
+    assert resumed.repeated == 2
+    assert list(google_images_download.KeywordFile(str(keywords))) == [
+        'cats', 'dogs', 'birds', 'fish']
+
+
+def test_keywords_from_file_checkpoints_completed_lines(stand_in_server,
+                                                        tmp_path):
+    keywords = tmp_path / 'keywords.txt'
+    keywords.write_text('car\nbike\ncar\n')
+    checkpoint = str(tmp_path / 'keywords.checkpoint')
+    parser = google_images_download.get_parser()
+    arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                   '--limit', '2', '--prefix_keywords',
+                                   'red,blue', '--term_workers', '3'])
+    arguments.search_keyword = google_images_download.KeywordFile(
+            str(keywords), checkpoint)
+    arguments.main_directory = str(tmp_path / 'downloads')
+    downloader = google_images_download.GoogleImagesDownloader()
+    paths, errors = downloader.download(arguments)
+    downloader.close()
+
+    assert paths == {}
+    assert sorted(os.listdir(arguments.main_directory)) == [
+        'blue bike', 'blue car', 'red bike', 'red car']
+    with open(checkpoint) as fh:
+        assert json.load(fh) == {'path': str(keywords), 'line': 2,
+                                 'offset': 9}
+
+
+@pytest.mark.parametrize('term_workers', ['1', '2'])
+def test_lines_whose_page_failed_are_not_checkpointed(stand_in_server,
+                                                      tmp_path, capsys,
+                                                      term_workers):
+    keywords = tmp_path / 'keywords.txt'
+    keywords.write_text('car\nbike\nfish\n')
+    checkpoint = str(tmp_path / 'keywords.checkpoint')
+    parser = google_images_download.get_parser()
+    arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                   '--limit', '2', '--term_workers',
+                                   term_workers, '--retries', '0'])
+    arguments.main_directory = str(tmp_path / 'downloads')
+    downloader = google_images_download.GoogleImagesDownloader()
+    build_search_url = downloader.build_search_url
+
+    def search_url(search_term, *args):
+        if search_term == 'bike':
+            return stand_in_server + '/down'
+        return build_search_url(search_term, *args)
+
+    downloader.build_search_url = search_url
+    arguments.search_keyword = google_images_download.KeywordFile(
+            str(keywords), checkpoint)
+    downloader.download(arguments)
+
+    def downloaded(name):
+        return len(os.listdir(os.path.join(arguments.main_directory, name)))
+
+    # the lines after the failed one are downloaded all the same
+    assert [downloaded(name) for name in ('car', 'bike', 'fish')] == [2, 0, 2]
+    assert 'Search term bike failed' in capsys.readouterr().out
+    with open(checkpoint) as fh:
+        assert json.load(fh)['line'] == 1
+
+    downloader.build_search_url = build_search_url
+    arguments.search_keyword = google_images_download.KeywordFile(
+            str(keywords), checkpoint, resume=True)
+    downloader.download(arguments)
+    downloader.close()
+    assert [downloaded(name) for name in ('car', 'bike', 'fish')] == [2, 2, 2]
+    with open(checkpoint) as fh:
+        assert json.load(fh)['line'] == 3
+
+
+def test_keyword_error_rate(tmp_path, monkeypatch, capsys):
+    keywords = tmp_path / 'keywords.txt'
+    keywords.write_text(''.join('keyword {}\n'.format(i)
+                                for i in range(3000)))
+    # every keyword is new, the ones skipped were taken for repeats
+    exact = google_images_download.KeywordFile(str(keywords))
+    assert len(list(exact)) == 3000
+    assert exact.repeated == 0
+
+    monkeypatch.setattr('sys.argv', ['googleimagesdownload',
+                                     '--keywords_from_file', str(keywords),
+                                     '--keyword_error_rate', '0.5'])
+    loose = google_images_download.user_input()[0].search_keyword
+    assert loose.error_rate == 0.5
+    assert len(list(loose)) + loose.repeated == 3000
+    assert loose.repeated > 100
+    assert abs(loose.mistaken - loose.repeated) < loose.repeated * 0.2
+    assert ('Skipped {} repeated keywords of {}, about {} of which may be '
+            'new keywords taken for repeats'.format(
+                loose.repeated, keywords,
+                min(loose.repeated, round(loose.mistaken)))
+            in capsys.readouterr().out)
+
+
+def test_work_queue_leases_expire_without_heartbeat(tmp_path):
+    path = str(tmp_path / 'queue.sqlite')
+    first = google_images_download.WorkQueue(path, lease=0.3, worker='first')
+    second = google_images_download.WorkQueue(path, lease=0.3,
+                                              worker='second')
+    terms = [(0, 'car', 'car'), (1, 'bike', 'bike')]
+    first.add(terms)
+    second.add(terms)
+    assert first.lease() == (0, 'car', 'car')
+    assert second.lease() == (1, 'bike', 'bike')
+    second.complete('bike', 2)
+
+    # renewed by the heartbeat of the first worker
+    time.sleep(0.6)
+    assert second.lease() is None
+    first.close()
+    time.sleep(0.6)
+    assert second.lease() == (0, 'car', 'car')
+    second.complete('car', 0)
+    assert second.counts() == {'done': 2}
+    assert list(second.leased()) == []
+    second.close()
+
+    db = sqlite3.connect(path)
+    assert db.execute('SELECT term, worker, attempts, errors FROM terms '
+                      'ORDER BY position').fetchall() == [
+        ('car', 'second', 2, 0), ('bike', 'second', 1, 2)]
+
+
+def test_work_queue_shares_terms_between_downloaders(stand_in_server,
+                                                     tmp_path):
+    path = str(tmp_path / 'queue.sqlite')
+    # a worker that died holding the lease of 'red car'
+    dead = google_images_download.WorkQueue(path, lease=0.1, worker='dead')
+    dead.add([(0, 'car', 'red car')])
+    dead.lease()
+    dead.stopped.set()
+
+    def work(name, results):
+        parser = google_images_download.get_parser()
+        arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                       '--limit', '2', '--prefix_keywords',
+                                       'red,blue', '--work_queue', path,
+                                       '--lease', '1'])
+        arguments.search_keyword = ['car', 'bike']
+        arguments.main_directory = str(tmp_path / name)
+        downloader = google_images_download.GoogleImagesDownloader()
+        results[name] = downloader.download(arguments)
+        downloader.close()
+
+    results = {}
+    workers = [threading.Thread(target=work, args=(name, results))
+               for name in ('one', 'two')]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    dead.close()
+
+    done = [term for paths, _ in results.values() for term in paths]
+    assert sorted(done) == ['blue bike', 'blue car', 'red bike', 'red car']
+    db = sqlite3.connect(path)
+    rows = db.execute('SELECT term, worker, attempts, errors FROM terms '
+                      'ORDER BY position').fetchall()
+    assert [row[0] for row in rows] == ['red car', 'red bike', 'blue car',
+                                        'blue bike']
+    assert 'dead' not in [row[1] for row in rows]
+    # leased again once the lease of the dead worker expired
+    assert [row[2] for row in rows] == [2, 1, 1, 1]
+    assert [row[3] for row in rows] == [0, 0, 0, 0]
+
+
+def test_work_queue_fails_terms_after_max_attempts(stand_in_server,
+                                                   tmp_path):
+    path = str(tmp_path / 'queue.sqlite')
+    parser = google_images_download.get_parser()
+    arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                   '--limit', '2', '--work_queue', path,
+                                   '--max_attempts', '2'])
+    arguments.search_keyword = ['car', 'bad', 'bike']
+    arguments.main_directory = str(tmp_path)
+    downloader = google_images_download.GoogleImagesDownloader()
+    download_term = downloader._download_term
+
+    def failing(arguments, options, i, ky, search_term):
+        if search_term == 'bad':
+            raise ValueError('no results page')
+        return download_term(arguments, options, i, ky, search_term)
+
+    downloader._download_term = failing
+    # the worker goes on past the failing term
+    paths, errors = downloader.download(arguments)
+    downloader.close()
+    assert sorted(paths) == ['bad', 'bike', 'car']
+    assert len(paths['car']) == len(paths['bike']) == 2
+    assert errors == 2
+
+    db = sqlite3.connect(path)
+    rows = db.execute('SELECT term, status, attempts, error FROM terms '
+                      'ORDER BY position').fetchall()
+    assert rows == [('car', 'done', 1, None),
+                    ('bad', 'failed', 2, 'ValueError: no results page'),
+                    ('bike', 'done', 1, None)]
+
+    # as does a term whose worker died on its last attempt
+    queue = google_images_download.WorkQueue(
+        str(tmp_path / 'other.sqlite'), lease=0.1, max_attempts=1)
+    queue.stopped.set()
+    queue.add([(0, 'car', 'car')])
+    assert queue.lease() == (0, 'car', 'car')
+    time.sleep(0.2)
+    assert queue.lease() is None
+    assert queue.counts() == {'failed': 1}
+    assert list(queue.leased()) == []
+    queue.close()
+
+
+def test_work_queue_fails_terms_whose_page_failed(stand_in_server, tmp_path):
+    path = str(tmp_path / 'queue.sqlite')
+    parser = google_images_download.get_parser()
+    arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                   '--limit', '2', '--work_queue', path,
+                                   '--max_attempts', '2', '--retries', '0'])
+    arguments.search_keyword = ['car', 'bike']
+    arguments.main_directory = str(tmp_path)
+    downloader = google_images_download.GoogleImagesDownloader()
+    build_search_url = downloader.build_search_url
+
+    def search_url(search_term, *args):
+        if search_term == 'bike':
+            return stand_in_server + '/down'
+        return build_search_url(search_term, *args)
+
+    downloader.build_search_url = search_url
+    paths, errors = downloader.download(arguments)
+    downloader.close()
+    assert paths['bike'] == []
+    assert errors == 2
+
+    db = sqlite3.connect(path)
+    status, attempts, error = db.execute(
+        "SELECT status, attempts, error FROM terms WHERE term = 'bike'"
+    ).fetchone()
+    assert (status, attempts) == ('failed', 2)
+    assert error.startswith('PageUnavailable: Could not open URL')
+
+
+def test_hash_index_matches_brute_force():
+    rng = random.Random(7)
+    keys = [rng.getrandbits(64) for _ in range(500)]
+    # near copies, a few bits off
+    keys += [key ^ (1 << rng.randrange(64)) ^ (1 << rng.randrange(64))
+             for key in keys[:100]]
+    for distance in (0, 4, 20):
+        index = google_images_download.HashIndex(distance)
+        for i, key in enumerate(keys):
+            index.add(key, i)
+        assert index.size == 600
+        for query in keys[:50] + [rng.getrandbits(64) for _ in range(50)]:
+            expected = sorted((i, bin(query ^ key).count('1'))
+                              for i, key in enumerate(keys)
+                              if bin(query ^ key).count('1') <= distance)
+            assert sorted(index.search(query)) == expected
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_near_duplicates_are_linked_to_the_first_copy(tmp_path, workers):
+    Image = pytest.importorskip('PIL.Image')
+    rng = random.Random(3)
+    picture = Image.new('L', (16, 12))
+    picture.putdata([rng.randrange(256) for _ in range(16 * 12)])
+    picture = picture.resize((320, 240), Image.BILINEAR).convert('RGB')
+    other = picture.transpose(Image.FLIP_LEFT_RIGHT)
+    for directory in ('cats', 'dogs', 'cats - thumbnail'):
+        (tmp_path / directory).mkdir()
+    picture.save(tmp_path / 'cats' / '1.cats.jpg', quality=95)
+    other.save(tmp_path / 'cats' / '2.cats.png')
+    # resized and recompressed copies
+    picture.resize((200, 150)).save(tmp_path / 'dogs' / '1.dogs.jpg',
+                                    quality=40)
+    picture.resize((64, 48)).save(tmp_path / 'cats - thumbnail' /
+                                  '1.cats.jpg')
+    (tmp_path / 'dogs' / '2.dogs.jpg').write_bytes(b'not an image')
+
+    downloader = google_images_download.GoogleImagesDownloader()
+    found = list(downloader.near_duplicates(str(tmp_path), 4, workers))
+    assert [(os.path.relpath(path, tmp_path),
+             os.path.relpath(original, tmp_path))
+            for path, original, _ in found] == [('dogs/1.dogs.jpg',
+                                                 'cats/1.cats.jpg')]
+    assert downloader.handle_near_duplicates(str(tmp_path), 'link', 4,
+                                             workers) == 1
+    assert os.path.samefile(tmp_path / 'dogs' / '1.dogs.jpg',
+                            tmp_path / 'cats' / '1.cats.jpg')
+    assert not os.path.samefile(tmp_path / 'cats - thumbnail' / '1.cats.jpg',
+                                tmp_path / 'cats' / '1.cats.jpg')
+
+
+def test_skipped_near_duplicates_resume_as_their_original(stand_in,
+                                                          stand_in_server,
+                                                          tmp_path):
+    Image = pytest.importorskip('PIL.Image')
+    buffer = io.BytesIO()
+    Image.radial_gradient('L').save(buffer, 'JPEG')
+    stand_in.picture = buffer.getvalue()
+
+    def run():
+        parser = google_images_download.get_parser()
+        arguments = parser.parse_args(['--url', stand_in_server + '/search',
+                                       '--limit', '3', '--resume',
+                                       '--near_duplicates', 'skip',
+                                       '--hash_workers', '1'])
+        arguments.search_keyword = ['test']
+        arguments.main_directory = str(tmp_path)
+        downloader = google_images_download.GoogleImagesDownloader()
+        paths, errors = downloader.download(arguments)
+        downloader.close()
+        return paths['test']
+
+    # every image is the same picture, only the first one is kept
+    first = run()
+    assert [os.path.basename(path) for path in first] == ['1.0.jpg']
+    assert sorted(os.listdir(tmp_path / 'test')) == ['1.0.jpg']
+
+    del stand_in.hits[:]
+    assert run() == first * 3
+    assert stand_in.hits == ['/search']
+    db = sqlite3.connect(str(tmp_path / 'manifest.sqlite'))
+    assert db.execute('SELECT DISTINCT path, size FROM images').fetchall() == [
+        (first[0], len(stand_in.picture))]
+
+
+def test_images_are_processed_as_they_are_downloaded(stand_in, tmp_path):
+    Image = pytest.importorskip('PIL.Image')
+    picture = Image.new('RGB', (300, 200), (200, 30, 30))
+    exif = Image.Exif()
+    exif[0x010f] = 'camera'
+    buffer = io.BytesIO()
+    picture.save(buffer, 'JPEG', exif=exif)
+    stand_in.picture = buffer.getvalue()
+
+    parser = google_images_download.get_parser()
+    arguments = parser.parse_args([
+        '--url', 'http://%s:%d/search' % stand_in.server_address,
+        '--limit', '3', '--workers', '2', '--thumbnail',
+        '--max_dimension', '60', '--convert_format', 'png',
+        '--thumbnail_size', '16', '--process_workers', '2',
+        '--dedupe_store', str(tmp_path / 'store')])
+    arguments.search_keyword = ['test']
+    arguments.main_directory = str(tmp_path / 'downloads')
+    downloader = google_images_download.GoogleImagesDownloader()
+    downloader.thumbnail_steps.append(
+        google_images_download.ImageOps.grayscale)
+    paths, errors = downloader.download(arguments)
+    downloader.close()
+
+    assert errors == 0
+    assert [os.path.basename(path) for path in paths['test']] == [
+        '1.0.png', '2.1.png', '3.2.png']
+    for path in paths['test']:
+        with Image.open(path) as image:
+            assert (image.format, image.size) == ('PNG', (60, 40))
+            assert not image.getexif()
+        with Image.open(path.replace('test/', 'test - thumbnail/')) as image:
+            assert (image.mode, image.size) == ('L', (16, 16))
+    assert not list(tmp_path.glob('downloads/*/.*.part'))
+    # the store holds the processed images, all the same
+    stored = [path for path in (tmp_path / 'store').glob('*/*')]
+    assert len(stored) == 2
+    assert downloader.stats.report()['phases']['process']['count'] == 6
+
+
+def test_image_results_have_the_format_saved(stand_in, tmp_path):
+    Image = pytest.importorskip('PIL.Image')
+    buffer = io.BytesIO()
+    Image.new('RGB', (30, 20), (200, 30, 30)).save(buffer, 'JPEG')
+    stand_in.picture = buffer.getvalue()
+
+    parser = google_images_download.get_parser()
+    arguments = parser.parse_args([
+        '--url', 'http://%s:%d/search' % stand_in.server_address,
+        '--limit', '2', '--convert_format', 'png', '--process_workers', '1'])
+    arguments.search_keyword = ['test']
+    arguments.main_directory = str(tmp_path)
+    downloader = google_images_download.GoogleImagesDownloader()
+    results = list(downloader.iter_download(arguments))
+    downloader.close()
+
+    assert [(os.path.basename(result.path), result.format)
+            for result in results] == [('1.0.png', 'png'), ('2.1.png', 'png')]
+    assert results[0].metadata['image_format'] == 'jpg'
+
+
+@pytest.mark.parametrize('option', [['--thumbnail_size', '16'],
+                                    ['--max_dimension', '60']])
+def test_only_the_files_with_steps_are_processed(stand_in, tmp_path, option):
+    Image = pytest.importorskip('PIL.Image')
+    exif = Image.Exif()
+    exif[0x010f] = 'camera'
+    buffer = io.BytesIO()
+    Image.new('RGB', (300, 200), (200, 30, 30)).save(buffer, 'JPEG',
+                                                     quality=98, exif=exif)
+    stand_in.picture = buffer.getvalue()
+
+    parser = google_images_download.get_parser()
+    arguments = parser.parse_args([
+        '--url', 'http://%s:%d/search' % stand_in.server_address,
+        '--limit', '2', '--thumbnail', '--process_workers', '1'] + option)
+    arguments.search_keyword = ['test']
+    arguments.main_directory = str(tmp_path)
+    downloader = google_images_download.GoogleImagesDownloader()
+    paths, errors = downloader.download(arguments)
+    downloader.close()
+
+    assert errors == 0
+    thumbnails = [path.replace('test/', 'test - thumbnail/')
+                  for path in paths['test']]
+    processed, kept = paths['test'], thumbnails
+    if option[0] == '--thumbnail_size':
+        processed, kept = kept, processed
+    # the files of the other kind are saved as they were served
+    for path in kept:
+        with open(path, 'rb') as fh:
+            assert fh.read() == stand_in.picture
+    for path in processed:
+        with Image.open(path) as image:
+            assert image.size in ((16, 16), (60, 40))
+            assert not image.getexif()
+
+
+def test_stripped_jpegs_keep_their_quality(stand_in, tmp_path):
+    Image = pytest.importorskip('PIL.Image')
+    exif = Image.Exif()
+    exif[0x010f] = 'camera'
+    buffer = io.BytesIO()
+    Image.radial_gradient('L').convert('RGB').save(buffer, 'JPEG',
+                                                    quality=95, exif=exif)
+    stand_in.picture = buffer.getvalue()
+
+    parser = google_images_download.get_parser()
+    arguments = parser.parse_args([
+        '--url', 'http://%s:%d/search' % stand_in.server_address,
+        '--limit', '1', '--strip_exif', '--process_workers', '1'])
+    arguments.search_keyword = ['test']
+    arguments.main_directory = str(tmp_path)
+    downloader = google_images_download.GoogleImagesDownloader()
+    paths, errors = downloader.download(arguments)
+    downloader.close()
+
+    with Image.open(io.BytesIO(stand_in.picture)) as served, \
+            Image.open(paths['test'][0]) as image:
+        assert not image.getexif()
+        assert image.quantization == served.quantization
+
+    # a rotated one is re-encoded upright
+    exif[0x0112] = 6
+    path = str(tmp_path / 'rotated.jpg')
+    Image.new('RGB', (30, 20)).save(path, 'JPEG', exif=exif)
+    google_images_download.process_image(path, [])
+    with Image.open(path) as image:
+        assert image.size == (20, 30)
+        assert not image.getexif()
+
+
+def test_manifest_keeps_the_partial_files_of_running_downloads(tmp_path):
+    path = str(tmp_path / 'manifest.sqlite')
+    running = google_images_download.Manifest(path)
+    partial = tmp_path / '.running.part'
+    partial.write_bytes(b'\xff\xd8')
+    running.started(str(tmp_path), 'http://example.com/1.jpg', str(partial))
+
+    # another record of the same --jobs run opening the manifest
+    google_images_download.Manifest(path, resume=True).close()
+    assert partial.exists()
+
+    # the process of the first one died
+    process = subprocess.Popen(['true'])
+    process.wait()
+    db = sqlite3.connect(path)
+    db.execute('UPDATE images SET owner = ?', (
+        running.owner.replace(':%d:' % os.getpid(), ':%d:' % process.pid),))
+    db.commit()
+    db.close()
+    google_images_download.Manifest(path, resume=True).close()
+    assert not partial.exists()
+    running.close()